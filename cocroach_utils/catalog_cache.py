@@ -0,0 +1,136 @@
+# In-process read-through cache of the small read-mostly tables (models and assistants).
+# The entries expire after a TTL and every write clears the cache of its worker at once. The writes also
+# increase the catalog version in the cache_versions table, so the other workers clear their cache
+# the next time they check the version.
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from cocroach_utils.database_utils import get_db_cursor, fetch_one
+
+load_dotenv()
+# seconds before an entry is read again from the database
+cache_ttl = float(os.getenv("CATALOG_CACHE_TTL", 300))
+# seconds between two checks of the catalog version written by the other workers
+version_check_interval = float(os.getenv("CATALOG_VERSION_CHECK", 5))
+
+lock = threading.Lock()
+entries = {}
+state = {
+    "version": None,
+    "checked": 0.0,
+    # increased on every invalidation, a value loaded before it is not saved
+    "generation": 0,
+}
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+}
+
+
+def get_catalog_version():
+    """
+    Get the version of the catalog in the database
+    :return: version, 0 if the catalog was never changed, None on error
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            row = fetch_one(cursor, "SELECT version FROM cache_versions WHERE name = %s", ("catalog",), native=True)
+            if row is None:
+                return None
+            return row['version'] if row else 0
+    return None
+
+
+def clear_entries():
+    """
+    Remove all the entries, the lock must be held
+    :return:
+    """
+    entries.clear()
+    state["generation"] += 1
+    stats["invalidations"] += 1
+
+
+def check_version():
+    """
+    Clear the cache if another worker changed the catalog since the last check
+    :return:
+    """
+    now = time.monotonic()
+    with lock:
+        if now - state["checked"] < version_check_interval:
+            return
+        state["checked"] = now
+
+    version = get_catalog_version()
+    if version is None:
+        return
+    with lock:
+        if version != state["version"]:
+            if state["version"] is not None:
+                clear_entries()
+            state["version"] = version
+
+
+def get_cached(key, loader):
+    """
+    Get the value from the cache or load it from the database
+    :param key:
+    :param loader: function that reads the value from the database
+    :return:
+    """
+    check_version()
+    with lock:
+        entry = entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            stats["hits"] += 1
+            return entry[0]
+        stats["misses"] += 1
+        generation = state["generation"]
+
+    value = loader()
+    # the errors and the missing rows are not cached
+    if value:
+        with lock:
+            if generation == state["generation"]:
+                entries[key] = (value, time.monotonic() + cache_ttl)
+    return value
+
+
+def invalidate_catalog():
+    """
+    Clear the cache after a write to the models or the assistants and tell the other workers
+    :return:
+    """
+    with lock:
+        clear_entries()
+
+    with get_db_cursor() as cursor:
+        if cursor:
+            row = fetch_one(cursor, "INSERT INTO cache_versions (name, version) VALUES (%s, 1) "
+                                    "ON CONFLICT (name) DO UPDATE SET version = cache_versions.version + 1 "
+                                    "RETURNING version", ("catalog",), native=True)
+            if row:
+                with lock:
+                    state["version"] = row['version']
+
+
+def get_catalog_cache_stats():
+    """
+    Get the counters of the cache
+    :return:
+    """
+    with lock:
+        requests = stats["hits"] + stats["misses"]
+        return {
+            "entries": len(entries),
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "hit_rate": stats["hits"] / requests if requests else 0.0,
+            "invalidations": stats["invalidations"],
+            "version": state["version"],
+        }
@@ -0,0 +1,243 @@
+# Cache of the state of the active conversations: the conversation row and its last turns, keyed by conv_id,
+# and the name and summary of the documents, keyed by doc_id. add_history writes the new turn through the cache,
+# the updates and deletes of the conversations, history and documents remove their entries.
+# The backend is in memory by default (one cache per worker) or a Redis-compatible server shared by the workers.
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+# memory or redis
+cache_backend = os.getenv("CONV_CACHE_BACKEND", "memory")
+cache_url = os.getenv("CONV_CACHE_URL", "redis://localhost:6379/0")
+# conversations and documents kept by the memory backend
+cache_size = int(os.getenv("CONV_CACHE_SIZE", 1000))
+# seconds before an entry of the redis backend expires
+cache_ttl = int(os.getenv("CONV_CACHE_TTL", 3600))
+# turns kept for every conversation
+cache_turns = int(os.getenv("CONV_CACHE_TURNS", 10))
+
+stats_lock = threading.Lock()
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "invalidations": 0,
+}
+
+
+class MemoryBackend:
+    """
+    LRU cache in the memory of the worker
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def update(self, key, func):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries[key] = func(value)
+
+    def delete(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def size(self):
+        return len(self.entries)
+
+
+class RedisBackend:
+    """
+    Cache shared by the workers in a Redis-compatible server, the entries expire after the ttl
+    """
+
+    def __init__(self, url, ttl):
+        # optional dependency, only needed with CONV_CACHE_BACKEND=redis
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value):
+        self.client.set(key, pickle.dumps(value), ex=self.ttl)
+
+    def update(self, key, func):
+        # not atomic: a turn written at the same time by another worker may be lost until the entry expires
+        value = self.get(key)
+        if value is not None:
+            self.set(key, func(value))
+
+    def delete(self, keys):
+        if keys:
+            self.client.delete(*keys)
+
+    def size(self):
+        return self.client.dbsize()
+
+
+if cache_backend == "redis":
+    backend = RedisBackend(cache_url, cache_ttl)
+else:
+    backend = MemoryBackend(cache_size)
+
+
+def conv_key(conv_id):
+    return f"conv:{conv_id}"
+
+
+def doc_key(doc_id):
+    return f"doc:{doc_id}"
+
+
+def count(name):
+    with stats_lock:
+        stats[name] += 1
+
+
+def get_conv_state(conv_id):
+    """
+    Get the cached conversation row and its last turns
+    :param conv_id:
+    :return: dict with conversation, history (newest first) and complete (no older turns), or None
+    """
+    state = backend.get(conv_key(conv_id))
+    count("hits" if state is not None else "misses")
+    return state
+
+
+def set_conv_state(conv_id, conversation, history, complete):
+    """
+    Save the conversation row and its last turns
+    :param conv_id:
+    :param conversation:
+    :param history: newest first
+    :param complete: True if the conversation has no older turns
+    :return:
+    """
+    backend.set(conv_key(conv_id), {
+        "conversation": conversation,
+        "history": history[:cache_turns],
+        "complete": complete and len(history) <= cache_turns,
+    })
+
+
+def add_turn(conv_id, prompt, answer):
+    """
+    Write the new turn through the cache, if the conversation is cached
+    :param conv_id:
+    :param prompt:
+    :param answer:
+    :return:
+    """
+    def add(state):
+        history = [{"prompt": prompt, "answer": answer}] + state["history"]
+        return {
+            "conversation": state["conversation"],
+            "history": history[:cache_turns],
+            "complete": state["complete"] and len(history) <= cache_turns,
+        }
+
+    backend.update(conv_key(conv_id), add)
+
+
+def update_conversation(conv_id, fields):
+    """
+    Write the new values of the conversation fields through the cache, if the conversation is cached
+    :param conv_id:
+    :param fields: dict field -> value
+    :return:
+    """
+    def update(state):
+        conversation = dict(state["conversation"])
+        conversation.update(fields)
+        return dict(state, conversation=conversation)
+
+    backend.update(conv_key(conv_id), update)
+
+
+def invalidate_convs(conv_ids):
+    """
+    Remove the conversations from the cache
+    :param conv_ids:
+    :return:
+    """
+    keys = [conv_key(conv_id) for conv_id in set(conv_ids)]
+    if keys:
+        backend.delete(keys)
+        count("invalidations")
+
+
+def get_doc_state(doc_id):
+    """
+    Get the cached name and summary of the document
+    :param doc_id:
+    :return: dict with doc_name and doc_summary, or None
+    """
+    state = backend.get(doc_key(doc_id))
+    count("hits" if state is not None else "misses")
+    return state
+
+
+def set_doc_state(doc_id, doc_name, doc_summary):
+    """
+    Save the name and summary of the document
+    :param doc_id:
+    :param doc_name:
+    :param doc_summary:
+    :return:
+    """
+    backend.set(doc_key(doc_id), {
+        "doc_name": doc_name,
+        "doc_summary": doc_summary,
+    })
+
+
+def invalidate_doc(doc_id):
+    """
+    Remove the document from the cache
+    :param doc_id:
+    :return:
+    """
+    backend.delete([doc_key(doc_id)])
+    count("invalidations")
+
+
+def get_conv_cache_stats():
+    """
+    Get the counters of the cache
+    :return:
+    """
+    with stats_lock:
+        requests = stats["hits"] + stats["misses"]
+        result = dict(stats)
+    result["hit_rate"] = result["hits"] / requests if requests else 0.0
+    result["backend"] = cache_backend
+    try:
+        result["entries"] = backend.size()
+    except Exception:
+        result["entries"] = None
+    return result
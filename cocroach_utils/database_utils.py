@@ -1,39 +1,282 @@
+import asyncio
+import base64
+import binascii
 import os
+import threading
+import time
+from collections import deque
+
+import orjson
 import psycopg2
 from contextlib import contextmanager
 from dotenv import load_dotenv
-from psycopg2 import pool
-from psycopg2.extras import RealDictCursor
+from psycopg2 import pool, sql
+from psycopg2.extras import RealDictCursor, execute_values
 import logging
 
+from utils.async_utils import run_blocking
+
 logging.basicConfig(filename='database.log', level=logging.ERROR)
 load_dotenv()
 database_url = os.getenv("CR_DATABASE_URL")
 
+pool_max_size = int(os.getenv("DB_POOL_MAX", 20))
+# seconds before a connection is replaced by a new one
+pool_max_lifetime = float(os.getenv("DB_POOL_MAX_LIFETIME", 1800))
+# seconds of idle time after which a connection is checked before it is used
+pool_health_check_after = float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", 30))
+# seconds to wait for a free connection
+pool_timeout = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# seconds save_error waits for a free connection, the exhausted pool is often the error being saved
+error_pool_timeout = float(os.getenv("DB_ERROR_POOL_TIMEOUT", 0.5))
+# rows returned by one page of the list endpoints
+max_page_size = int(os.getenv("MAX_PAGE_SIZE", 200))
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections with health checks, max lifetime recycling and usage metrics
+    """
+
+    def __init__(self, dsn, maxconn, max_lifetime, health_check_after, timeout):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        # idle connections with their creation and last use time, the most recently used at the end
+        self.idle = deque()
+        self.in_use = {}
+        self.size = 0
+        self.metrics = {
+            "acquired": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "broken": 0,
+        }
+
+    def connect(self):
+        """
+        Open a new connection
+        :return:
+        """
+        conn = psycopg2.connect(self.dsn)
+        with self.condition:
+            self.metrics["created"] += 1
+        return conn
+
+    def is_healthy(self, conn):
+        """
+        Check that the connection still works
+        :param conn:
+        :return:
+        """
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def close_quietly(self, conn):
+        """
+        Close the connection ignoring errors
+        :param conn:
+        :return:
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self, timeout=None):
+        """
+        Get a connection, wait up to timeout seconds when all of them are in use
+        :param timeout: seconds to wait, the timeout of the pool if None
+        :return:
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.monotonic()
+        waited = False
+        conn = None
+        with self.condition:
+            while True:
+                if self.idle:
+                    conn, created, last_used = self.idle.pop()
+                    break
+                if self.size < self.maxconn:
+                    # reserve the slot, the connection is opened outside the lock
+                    self.size += 1
+                    break
+                waited = True
+                remaining = timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self.metrics["timeouts"] += 1
+                    raise pool.PoolError("connection pool exhausted")
+                self.condition.wait(remaining)
+
+        now = time.monotonic()
+        try:
+            if conn is None:
+                conn = self.connect()
+                created = now
+            elif now - created > self.max_lifetime:
+                self.close_quietly(conn)
+                conn = self.connect()
+                created = now
+                with self.condition:
+                    self.metrics["recycled"] += 1
+            elif now - last_used > self.health_check_after and not self.is_healthy(conn):
+                self.close_quietly(conn)
+                conn = self.connect()
+                created = now
+                with self.condition:
+                    self.metrics["broken"] += 1
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+        wait_time = time.monotonic() - start
+        with self.condition:
+            self.in_use[id(conn)] = created
+            self.metrics["acquired"] += 1
+            if waited:
+                self.metrics["waits"] += 1
+            self.metrics["wait_time_total"] += wait_time
+            self.metrics["wait_time_max"] = max(self.metrics["wait_time_max"], wait_time)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return the connection to the pool
+        :param conn:
+        :param close: the connection is broken and must not be reused
+        :return:
+        """
+        now = time.monotonic()
+        with self.condition:
+            created = self.in_use.pop(id(conn), now)
+            if close or conn.closed or now - created > self.max_lifetime:
+                self.size -= 1
+                if close:
+                    self.metrics["broken"] += 1
+            else:
+                self.idle.append((conn, created, now))
+                conn = None
+            self.condition.notify()
+        if conn is not None:
+            self.close_quietly(conn)
+
+    def get_metrics(self):
+        """
+        Get the usage counters of the pool
+        :return:
+        """
+        with self.condition:
+            return {
+                **self.metrics,
+                "size": self.size,
+                "in_use": len(self.in_use),
+                "idle": len(self.idle),
+                "max_size": self.maxconn,
+                "wait_time_avg": self.metrics["wait_time_total"] / self.metrics["acquired"]
+                if self.metrics["acquired"] else 0.0,
+            }
+
+
 # Create a connection pool
-db_pool = psycopg2.pool.SimpleConnectionPool(1, 20, database_url)
+db_pool = ConnectionPool(database_url, pool_max_size, pool_max_lifetime, pool_health_check_after, pool_timeout)
+
+# async callers wait here for a connection, so the worker threads never block on the pool
+async_db_semaphore = None
+async_metrics = {
+    "calls": 0,
+    "waits": 0,
+    "wait_time_total": 0.0,
+    "wait_time_max": 0.0,
+}
 
 
 @contextmanager
-def get_db_cursor():
-    conn = db_pool.getconn()
+def get_db_cursor(dict_rows=True, raise_errors=False, timeout=None):
+    """
+    Cursor of a pooled connection, the block is committed at the end or rolled back on error
+    :param dict_rows: rows as dicts, as tuples otherwise
+    :param raise_errors: raise the error after the rollback instead of only logging it
+    :param timeout: seconds to wait for a free connection, the timeout of the pool if None
+    :return:
+    """
+    conn = db_pool.getconn(timeout)
+    broken = False
     try:
-        with conn.cursor(cursor_factory=RealDictCursor) as cursor:
+        # rows as dicts by default, as tuples for the compact pages
+        with conn.cursor(cursor_factory=RealDictCursor if dict_rows else None) as cursor:
             yield cursor
         conn.commit()
     except Exception as err:
-        conn.rollback()
+        broken = isinstance(err, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        if not conn.closed:
+            conn.rollback()
         logging.error("Failed to get cursor: ", exc_info=True)
+        if raise_errors:
+            raise
     finally:
-        db_pool.putconn(conn)
+        db_pool.putconn(conn, close=broken)
+
+
+async def run_db(func, *args, **kwargs):
+    """
+    Run a database function from async code, waiting for a free connection without blocking the event loop
+    :param func:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    global async_db_semaphore
+    if async_db_semaphore is None:
+        async_db_semaphore = asyncio.Semaphore(pool_max_size)
+
+    start = time.monotonic()
+    waited = async_db_semaphore.locked()
+    async with async_db_semaphore:
+        wait_time = time.monotonic() - start
+        async_metrics["calls"] += 1
+        if waited:
+            async_metrics["waits"] += 1
+        async_metrics["wait_time_total"] += wait_time
+        async_metrics["wait_time_max"] = max(async_metrics["wait_time_max"], wait_time)
+        return await run_blocking(func, *args, **kwargs)
 
 
-def fetch_all(cursor, query, params=None):
+def get_pool_metrics():
+    """
+    Get the metrics of the connection pool and of the async callers
+    :return:
+    """
+    return {
+        "pool": db_pool.get_metrics(),
+        "async": dict(async_metrics),
+    }
+
+
+def fetch_all(cursor, query, params=None, native=False):
     """
     Fetch all rows from the database
     :param cursor:
     :param query:
     :param params:
+    :param native: keep the database types instead of converting every value to str
     :return:
     """
     try:
@@ -43,6 +286,9 @@ def fetch_all(cursor, query, params=None):
         if result is None:
             return []
 
+        if native:
+            return result
+
         result = [{k: str(v) for k, v in row.items()} for row in result]
         return result
 
@@ -51,12 +297,13 @@ def fetch_all(cursor, query, params=None):
         return []
 
 
-def fetch_one(cursor, query, params):
+def fetch_one(cursor, query, params, native=False):
     """
     Fetch one row from the database
     :param cursor:
     :param query:
     :param params:
+    :param native: keep the database types instead of converting every value to str
     :return:
     """
     try:
@@ -64,6 +311,8 @@ def fetch_one(cursor, query, params):
         result = cursor.fetchone()
         if result is None:
             return []
+        if native:
+            return result
         result = {k: str(v) for k, v in result.items()}
         return result
 
@@ -72,6 +321,156 @@ def fetch_one(cursor, query, params):
         return None
 
 
+def encode_page_token(values):
+    """
+    Encode the sort key of the last row of a page as an opaque token
+    :param values:
+    :return:
+    """
+    return base64.urlsafe_b64encode(orjson.dumps(values, default=str)).decode("ascii")
+
+
+def decode_page_token(page_token, size):
+    """
+    Decode the sort key of the last row of the previous page
+    :param page_token:
+    :param size: number of key columns
+    :return:
+    """
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(page_token.encode("ascii")))
+    except (binascii.Error, ValueError, UnicodeEncodeError):
+        raise ValueError("Invalid page token")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid page token")
+    return values
+
+
+def build_page_query(source, columns, selected, key_columns, where, params, page_token, page_size):
+    """
+    Build the keyset query of one page, sorted by the key columns from the newest row to the oldest one.
+    The page after the token starts right after its last row, so every page costs the same however deep it is.
+    :param source: FROM clause
+    :param columns: allowed columns, name -> sql expression
+    :param selected: names of the requested columns, all the allowed columns if empty
+    :param key_columns: names of the unique sort key, always returned
+    :param where: filter with %s placeholders
+    :param params: values of the filter
+    :param page_token: token of the previous page or None for the first one
+    :param page_size:
+    :return: query and params, the query asks for one row more than the page to know if there is a next page
+    """
+    selected = list(selected or columns.keys())
+    for name in selected:
+        if name not in columns:
+            raise ValueError("Unknown column: " + str(name))
+    for name in key_columns:
+        if name not in selected:
+            selected.append(name)
+
+    conditions = [sql.SQL(where)] if where else []
+    params = list(params)
+    if page_token:
+        conditions.append(sql.SQL("({}) < ({})").format(
+            sql.SQL(", ").join(sql.SQL(columns[name]) for name in key_columns),
+            sql.SQL(", ").join(sql.Placeholder() for _ in key_columns)))
+        params.extend(decode_page_token(page_token, len(key_columns)))
+
+    query = sql.SQL("SELECT {} FROM {}{} ORDER BY {} LIMIT %s").format(
+        sql.SQL(", ").join(sql.SQL("{} AS {}").format(sql.SQL(columns[name]), sql.Identifier(name))
+                           for name in selected),
+        sql.SQL(source),
+        sql.SQL(" WHERE ") + sql.SQL(" AND ").join(conditions) if conditions else sql.SQL(""),
+        sql.SQL(", ").join(sql.SQL("{} DESC").format(sql.SQL(columns[name])) for name in key_columns))
+    params.append(min(max(page_size, 1), max_page_size) + 1)
+    return query, params
+
+
+def fetch_page(cursor, query, params, key_columns):
+    """
+    Fetch one page built by build_page_query
+    :param cursor: with dict_rows=False the rows are tuples and the columns are returned once
+    :param query:
+    :param params:
+    :param key_columns:
+    :return: dict with the rows and the token of the next page, None on the last page
+    """
+    try:
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        columns = [column.name for column in cursor.description]
+        page_size = params[-1] - 1
+
+        next_page_token = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            last = rows[-1]
+            if isinstance(last, dict):
+                next_page_token = encode_page_token([last[name] for name in key_columns])
+            else:
+                next_page_token = encode_page_token([last[columns.index(name)] for name in key_columns])
+
+        page = {
+            "rows": rows,
+            "next_page_token": next_page_token,
+        }
+        if rows and not isinstance(rows[0], dict):
+            page["columns"] = columns
+        return page
+
+    except Exception as e:
+        save_error(e, cursor)
+        return {
+            "rows": [],
+            "next_page_token": None,
+        }
+
+
+def update_fields(cursor, table, key_column, keys, fields, returning=None):
+    """
+    Update several fields of one or more rows in a single statement, the names are quoted as identifiers
+    :param cursor:
+    :param table:
+    :param key_column:
+    :param keys: ids of the rows
+    :param fields: dict field -> value
+    :param returning: column to return for every updated row
+    :return: number of updated rows, or the list of the returned values
+    """
+    query = sql.SQL("UPDATE {} SET {} WHERE {} = ANY(%s)").format(
+        sql.Identifier(table),
+        sql.SQL(", ").join(sql.SQL("{} = %s").format(sql.Identifier(field)) for field in fields),
+        sql.Identifier(key_column))
+    if returning is not None:
+        query += sql.SQL(" RETURNING {}").format(sql.Identifier(returning))
+    cursor.execute(query, list(fields.values()) + [list(keys)])
+    if returning is None:
+        return cursor.rowcount
+    return [row[returning] if isinstance(row, dict) else row[0] for row in cursor.fetchall()]
+
+
+def insert_rows(cursor, table, columns, rows, returning=None, page_size=500):
+    """
+    Insert the rows with multi-row VALUES statements
+    :param cursor:
+    :param table:
+    :param columns:
+    :param rows: tuples of values in the order of the columns
+    :param returning: column to return for every inserted row
+    :param page_size: rows in one statement
+    :return: list of the returned values, or the number of rows when returning is None
+    """
+    query = sql.SQL("INSERT INTO {} ({}) VALUES %s").format(
+        sql.Identifier(table),
+        sql.SQL(", ").join(sql.Identifier(column) for column in columns))
+    if returning is None:
+        execute_values(cursor, query.as_string(cursor), rows, page_size=page_size)
+        return len(rows)
+    query += sql.SQL(" RETURNING {}").format(sql.Identifier(returning))
+    result = execute_values(cursor, query.as_string(cursor), rows, page_size=page_size, fetch=True)
+    return [row[returning] if isinstance(row, dict) else row[0] for row in result]
+
+
 def save_error(error, metadata=None):
     """
     Save an error to the database
@@ -82,13 +481,17 @@ def save_error(error, metadata=None):
     error_message = str(error)
     print(error_message)
     logging.error("An error occurred: ", exc_info=True)
-    with get_db_cursor() as cursor:
-        try:
-            cursor.execute(
-                "INSERT INTO errors (error_text, metadata) VALUES (%s, %s)",
-                (error_message, metadata)
-            )
-        except Exception as e:
-            logging.error("Failed to save error to database: ", exc_info=True)
+    try:
+        with get_db_cursor(timeout=error_pool_timeout) as cursor:
+            try:
+                cursor.execute(
+                    "INSERT INTO errors (error_text, metadata) VALUES (%s, %s)",
+                    (error_message, metadata)
+                )
+            except Exception as e:
+                logging.error("Failed to save error to database: ", exc_info=True)
+    except (pool.PoolError, psycopg2.OperationalError):
+        # no connection within error_pool_timeout, the error is only logged
+        logging.error("Failed to save error to database: ", exc_info=True)
 
     return -1
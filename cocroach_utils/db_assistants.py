@@ -1,9 +1,10 @@
-from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one
+from cocroach_utils.catalog_cache import get_cached, invalidate_catalog
+from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one, update_fields
 
 
-def get_all_assistants():
+def query_all_assistants():
     """
-    Get all assistants
+    Get all assistants from the database
     :return:
     """
     with get_db_cursor() as cursor:
@@ -12,9 +13,9 @@ def get_all_assistants():
     return []
 
 
-def get_assistant_by_id(assistant_id):
+def query_assistant_by_id(assistant_id):
     """
-    Get assistant by conv_id
+    Get assistant by assist_id from the database
     :param assistant_id:
     :return:
     """
@@ -24,6 +25,23 @@ def get_assistant_by_id(assistant_id):
     return None
 
 
+def get_all_assistants():
+    """
+    Get all assistants, cached
+    :return:
+    """
+    return get_cached(("assistants",), query_all_assistants)
+
+
+def get_assistant_by_id(assistant_id):
+    """
+    Get assistant by assist_id, cached
+    :param assistant_id:
+    :return:
+    """
+    return get_cached(("assistant", str(assistant_id)), lambda: query_assistant_by_id(assistant_id))
+
+
 def get_assistant_by_name(assistant_name):
     """
     Get assistant by name
@@ -58,13 +76,16 @@ def add_assistant(title, description="", welcome_message="", system_prompt="", u
     :param user:
     :return:
     """
+    result = -1
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_one(cursor,
-                             "INSERT INTO assistants (name, description, welcome, system_prompt, user_id) VALUES (%s, "
-                             "%s, %s, %s, %s) RETURNING assist_id",
-                             (title, description, welcome_message, system_prompt, user))['assist_id']
-    return -1
+            result = fetch_one(cursor,
+                               "INSERT INTO assistants (name, description, welcome, system_prompt, user_id) "
+                               "VALUES (%s, %s, %s, %s, %s) RETURNING assist_id",
+                               (title, description, welcome_message, system_prompt, user))['assist_id']
+    if result != -1:
+        invalidate_catalog()
+    return result
 
 
 def update_assistant(assistant_id, title, description, welcome_message, system_prompt, user):
@@ -78,14 +99,17 @@ def update_assistant(assistant_id, title, description, welcome_message, system_p
     :param user:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
             cursor.execute(
                 "UPDATE assistants SET name = %s, description = %s, welcome = %s, system_prompt = %s, user_id = %s "
                 "WHERE assist_id = %s",
                 (title, description, welcome_message, system_prompt, user, assistant_id))
-            return cursor.rowcount == 1
-    return False
+            result = cursor.rowcount == 1
+    if result:
+        invalidate_catalog()
+    return result
 
 
 def update_assistant_field(assistant_id, field, value):
@@ -96,12 +120,13 @@ def update_assistant_field(assistant_id, field, value):
     :param value:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("UPDATE assistants SET " + field + " = %s WHERE _id = %s",
-                           (value, assistant_id))
-            return cursor.rowcount == 1
-    return False
+            result = update_fields(cursor, "assistants", "assist_id", [assistant_id], {field: value}) == 1
+    if result:
+        invalidate_catalog()
+    return result
 
 
 def delete_assistant(assistant_id):
@@ -110,8 +135,11 @@ def delete_assistant(assistant_id):
     :param assistant_id:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
             cursor.execute("DELETE FROM assistants WHERE assist_id = %s", (assistant_id,))
-            return cursor.rowcount == 1
-    return False
+            result = cursor.rowcount == 1
+    if result:
+        invalidate_catalog()
+    return result
@@ -0,0 +1,70 @@
+# Everything one chat turn needs, read from the conversation cache or from the database in a single round trip
+# (the models and the assistants come from the catalog cache)
+from cocroach_utils.conv_cache import get_conv_state, set_conv_state, get_doc_state, set_doc_state
+from cocroach_utils.database_utils import get_db_cursor, fetch_one
+from cocroach_utils.db_conv import add_catalog_names
+
+conversation_fields = ("conv_id", "user_id", "doc_id", "title", "active", "summary", "summary_until", "memory", "model",
+                       "assistant")
+
+
+def get_turn_context(conversation_id, doc_id=None, limit=2):
+    """
+    Get the conversation, the document and the last turns in one query, the names of the model and the assistant
+    come from the catalog cache
+    :param conversation_id:
+    :param doc_id:
+    :param limit: number of turns of history
+    :return: dict with the conversation fields, doc_name, doc_summary and history (newest first)
+    """
+    context = get_cached_context(conversation_id, doc_id, limit)
+    if context is not None:
+        return add_catalog_names(context)
+
+    context = None
+    with get_db_cursor() as cursor:
+        if cursor:
+            context = fetch_one(cursor,
+                                "SELECT conversations.conv_id, conversations.user_id, conversations.doc_id, "
+                                "conversations.title, conversations.active, conversations.summary, "
+                                "conversations.summary_until, "
+                                "conversations.memory, conversations.model, conversations.assistant, "
+                                "documents.name AS doc_name, documents.summary AS doc_summary, "
+                                "(SELECT json_agg(json_build_object('prompt', h.prompt, 'answer', h.answer) "
+                                "ORDER BY h.time DESC) FROM (SELECT prompt, answer, time FROM history "
+                                "WHERE conv_id = %s ORDER BY time DESC LIMIT %s) AS h) AS history "
+                                "FROM conversations "
+                                "LEFT JOIN documents ON documents.doc_id = %s "
+                                "WHERE conversations.conv_id = %s",
+                                (conversation_id, limit, doc_id, conversation_id), native=True)
+    if context:
+        history = context['history'] or []
+        set_conv_state(conversation_id, {field: context[field] for field in conversation_fields}, history,
+                       len(history) < limit)
+        if doc_id is not None and context['doc_name'] is not None:
+            set_doc_state(doc_id, context['doc_name'], context['doc_summary'])
+        add_catalog_names(context)
+    return context
+
+
+def get_cached_context(conversation_id, doc_id, limit):
+    """
+    Build the context of the turn from the conversation cache
+    :param conversation_id:
+    :param doc_id:
+    :param limit: number of turns of history
+    :return: the same dict as get_turn_context, or None if a part is not cached
+    """
+    state = get_conv_state(conversation_id)
+    if state is None or (len(state['history']) < limit and not state['complete']):
+        return None
+    doc = {"doc_name": None, "doc_summary": None}
+    if doc_id is not None:
+        doc = get_doc_state(doc_id)
+        if doc is None:
+            return None
+
+    context = dict(state['conversation'])
+    context.update(doc)
+    context['history'] = list(state['history'][:limit])
+    return context
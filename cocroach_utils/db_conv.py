@@ -1,8 +1,25 @@
 # This file contains all the functions for the conversations table
-from cocroach_utils.db_history import delete_history_by_conv_id
-from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one
+from cocroach_utils.conv_cache import invalidate_convs, update_conversation
+from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one, build_page_query, fetch_page, \
+    update_fields
+from cocroach_utils.db_assistants import get_assistant_by_id
+from cocroach_utils.db_models import get_model_by_id
 from cocroach_utils.db_users import get_user_by_id
 
+conversation_columns = {
+    "conv_id": "conversations.conv_id",
+    "user_id": "conversations.user_id",
+    "doc_id": "conversations.doc_id",
+    "title": "conversations.title",
+    "active": "conversations.active",
+    "summary": "conversations.summary",
+    "model": "models.name",
+    "assistant": "assistants.name",
+    "system_prompt": "assistants.system_prompt",
+    "memory": "conversations.memory",
+}
+conversation_key = ("conv_id",)
+
 
 def get_all_conversations_by_user(user_id):
     """
@@ -24,10 +41,11 @@ def get_all_conversations_by_user(user_id):
     return []
 
 
-def get_user_conversations(user_id):
+def get_user_conversations(user_id, native=False):
     """
     Get all conversations for the user
     :param user_id:
+    :param native: keep the database types
     :return:
     """
     with get_db_cursor() as cursor:
@@ -37,25 +55,64 @@ def get_user_conversations(user_id):
                              "models.name, assistants.name, assistants.system_prompt, memory FROM conversations "
                              "LEFT JOIN models ON conversations.model = models.model_id LEFT "
                              "JOIN assistants ON conversations.assistant = assistants.assist_id "
-                             "WHERE conversations.user_id = %s", (user_id,))
+                             "WHERE conversations.user_id = %s", (user_id,), native)
     return []
 
 
-def get_conv_by_id(conversation_id):
+def get_user_conversations_page(user_id, limit=10, page_token=None, columns=None):
+    """
+    Get one page of the conversations of the user, from the newest to the oldest one
+    :param user_id:
+    :param limit: rows in the page
+    :param page_token: next_page_token of the previous page
+    :param columns: columns to return, all if empty
+    :return: dict with the rows and next_page_token
+    """
+    query, params = build_page_query("conversations LEFT JOIN models ON conversations.model = models.model_id "
+                                     "LEFT JOIN assistants ON conversations.assistant = assistants.assist_id",
+                                     conversation_columns, columns, conversation_key, "conversations.user_id = %s",
+                                     (user_id,), page_token, limit)
+    with get_db_cursor() as cursor:
+        if cursor:
+            return fetch_page(cursor, query, params, conversation_key)
+    return {"rows": [], "next_page_token": None}
+
+
+def get_conv_by_id(conversation_id, native=False):
     """
     Get selected conversation
     :param conversation_id:
+    :param native: keep the database types
     :return:
     """
+    conversation = []
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_one(cursor,
-                             "SELECT conv_id, conversations.user_id, doc_id, conversations.title, active, summary, "
-                             "models.name, assistants.name, assistants.system_prompt, memory FROM conversations "
-                             "LEFT JOIN models ON conversations.model = models.model_id LEFT "
-                             "JOIN assistants ON conversations.assistant = assistants.assist_id "
-                             "WHERE conv_id = %s", (conversation_id,))
-    return []
+            conversation = fetch_one(cursor,
+                                     "SELECT conv_id, user_id, doc_id, title, active, summary, model, assistant, "
+                                     "memory FROM conversations WHERE conv_id = %s", (conversation_id,), native)
+    if conversation:
+        add_catalog_names(conversation)
+    return conversation
+
+
+def add_catalog_names(conversation):
+    """
+    Replace the ids of the model and the assistant of the conversation by their names, read from the catalog cache
+    :param conversation: row with the model and assistant ids
+    :return:
+    """
+    model = None
+    if conversation['model'] not in (None, 'None'):
+        model = get_model_by_id(conversation['model'])
+    assistant = None
+    if conversation['assistant'] not in (None, 'None'):
+        assistant = get_assistant_by_id(conversation['assistant'])
+
+    conversation['model'] = model['name'] if model else None
+    conversation['assistant'] = assistant['name'] if assistant else None
+    conversation['system_prompt'] = assistant['system_prompt'] if assistant else None
+    return conversation
 
 
 def add_conversation(user_id, doc_id=None, title="New conversation", model=0, assistant=0):
@@ -84,43 +141,68 @@ def update_conversation_field(conversation_id, field, value):
     :param value:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("UPDATE conversations SET " + field + " = %s WHERE conv_id = %s",
-                           (value, conversation_id))
-            return cursor.rowcount == 1
-    return False
+            result = update_fields(cursor, "conversations", "conv_id", [conversation_id], {field: value}) == 1
+    invalidate_convs([conversation_id])
+    return result
 
 
-def delete_conversation(conversation_id):
+def update_conversation_summary(conversation_id, summary, summary_until):
     """
-    Delete conversation from the database
+    Save the rolling summary of the conversation
     :param conversation_id:
+    :param summary:
+    :param summary_until: time of the last summarized turn
     :return:
     """
+    fields = {"summary": summary, "summary_until": summary_until}
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("DELETE FROM conversations WHERE conv_id = %s", (conversation_id,))
-            return cursor.rowcount == 1
-    return False
+            result = update_fields(cursor, "conversations", "conv_id", [conversation_id], fields) == 1
+    if result:
+        update_conversation(conversation_id, fields)
+    else:
+        invalidate_convs([conversation_id])
+    return result
 
 
-def delete_conversation_by_user(user_id, delete_history=False):
+def delete_conversation(conversation_id, delete_history=False):
     """
     Delete conversation from the database
-    :param delete_history:
-    :param user_id:
+    :param conversation_id:
+    :param delete_history: delete its history in the same transaction
     :return:
     """
+    result = False
+    with get_db_cursor() as cursor:
+        if cursor:
+            if delete_history:
+                cursor.execute("DELETE FROM history WHERE conv_id = %s", (conversation_id,))
+            cursor.execute("DELETE FROM conversations WHERE conv_id = %s", (conversation_id,))
+            result = cursor.rowcount == 1
+    invalidate_convs([conversation_id])
+    return result
 
-    if delete_history:
-        # get all conversations for the user
-        conversations = get_user_conversations(user_id)
-        for conv in conversations:
-            delete_history_by_conv_id(conv[0])
 
+def delete_conversation_by_user(user_id, delete_history=False):
+    """
+    Delete all the conversations of the user, with set-based statements in one transaction
+    :param delete_history: delete the history of the conversations too
+    :param user_id:
+    :return: number of deleted conversations, -1 on error
+    """
+    conv_ids = None
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("DELETE FROM conversations WHERE user_id = %s", (user_id,))
-            return cursor.rowcount == 1
-    return False
+            if delete_history:
+                cursor.execute("DELETE FROM history WHERE conv_id IN "
+                               "(SELECT conv_id FROM conversations WHERE user_id = %s)", (user_id,))
+            cursor.execute("DELETE FROM conversations WHERE user_id = %s RETURNING conv_id", (user_id,))
+            conv_ids = [row['conv_id'] for row in cursor.fetchall()]
+    if conv_ids is None:
+        return -1
+    invalidate_convs(conv_ids)
+    return len(conv_ids)
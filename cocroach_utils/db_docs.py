@@ -2,44 +2,82 @@
 import time
 import pandas as pd
 
-from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one
+from cocroach_utils.conv_cache import invalidate_doc
+from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one, build_page_query, fetch_page, \
+    update_fields
+from vectordb.store_cache import invalidate_vector_store
 
+doc_columns = {
+    "doc_id": "doc_id",
+    "user_id": "user_id",
+    "name": "name",
+    "summary": "summary",
+    "updated": "updated",
+    "active": "active",
+    "content_hash": "content_hash",
+}
+doc_key = ("doc_id",)
 
-def get_user_docs(user_id):
+
+def get_user_docs(user_id, native=False):
     """
     Get all docs for the user
     :param user_id:
+    :param native: keep the database types
     :return:
     """
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_all(cursor, "SELECT * FROM documents WHERE user_id = %s AND active = true", (user_id,))
+            return fetch_all(cursor, "SELECT * FROM documents WHERE user_id = %s AND active = true", (user_id,),
+                             native)
     return []
 
 
-def get_doc_by_id(doc_id):
+def get_doc_by_id(doc_id, native=False):
     """
     Get doc by conv_id
     :param doc_id:
+    :param native: keep the database types
     :return:
     """
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_one(cursor, "SELECT * FROM documents WHERE doc_id = %s", (doc_id,))
+            return fetch_one(cursor, "SELECT * FROM documents WHERE doc_id = %s", (doc_id,), native)
     return None
 
 
-def get_all_docs():
+def get_all_docs(native=False):
     """
     Get all docs
+    :param native: keep the database types
     :return:
     """
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_all(cursor, "SELECT * FROM documents")
+            return fetch_all(cursor, "SELECT * FROM documents", native=native)
     return []
 
 
+def get_docs_page(user_id=None, limit=10, page_token=None, columns=None):
+    """
+    Get one page of the active docs of the user, or of all the docs, from the newest to the oldest one
+    :param user_id: None for all the docs
+    :param limit: rows in the page
+    :param page_token: next_page_token of the previous page
+    :param columns: columns to return, all if empty
+    :return: dict with the rows and next_page_token
+    """
+    if user_id is None:
+        where, params = "", ()
+    else:
+        where, params = "user_id = %s AND active = true", (user_id,)
+    query, params = build_page_query("documents", doc_columns, columns, doc_key, where, params, page_token, limit)
+    with get_db_cursor() as cursor:
+        if cursor:
+            return fetch_page(cursor, query, params, doc_key)
+    return {"rows": [], "next_page_token": None}
+
+
 def get_doc_by_name(doc_name):
     """
     Get doc by name
@@ -52,19 +90,38 @@ def get_doc_by_name(doc_name):
     return None
 
 
-def add_doc(user_id, doc_name, doc_text):
+def get_doc_by_hash(content_hash, user_id=None):
+    """
+    Get the latest active doc with the same file content, for the user if user_id is given
+    :param content_hash: sha256 of the file
+    :param user_id:
+    :return:
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            if user_id is None:
+                return fetch_one(cursor, "SELECT * FROM documents WHERE content_hash = %s AND active = true "
+                                         "ORDER BY updated DESC LIMIT 1", (content_hash,))
+            return fetch_one(cursor, "SELECT * FROM documents WHERE content_hash = %s AND user_id = %s "
+                                     "AND active = true ORDER BY updated DESC LIMIT 1", (content_hash, user_id))
+    return None
+
+
+def add_doc(user_id, doc_name, doc_text, content_hash=None):
     """
     Add doc to the database and return the new doc_id
     :param user_id:
     :param doc_name:
     :param doc_text:
+    :param content_hash: sha256 of the file
     :return: doc_id
     """
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_one(cursor, "INSERT INTO documents (user_id, name, summary, updated) VALUES (%s, %s, %s, %s) "
-                                     "RETURNING doc_id",
-                             (user_id, doc_name, doc_text, pd.Timestamp(time.time(), unit='s')))['doc_id']
+            return fetch_one(cursor, "INSERT INTO documents (user_id, name, summary, updated, content_hash) "
+                                     "VALUES (%s, %s, %s, %s, %s) RETURNING doc_id",
+                             (user_id, doc_name, doc_text, pd.Timestamp(time.time(), unit='s'),
+                              content_hash))['doc_id']
     return -1
 
 
@@ -76,12 +133,13 @@ def update_doc_field_by_id(doc_id, field, value):
     :param value:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("UPDATE documents SET " + field + " = %s, updated = %s WHERE doc_id = %s",
-                           (value, pd.Timestamp(time.time(), unit='s'), doc_id))
-            return cursor.rowcount == 1
-    return False
+            result = update_fields(cursor, "documents", "doc_id", [doc_id],
+                                   {field: value, "updated": pd.Timestamp(time.time(), unit='s')}) == 1
+    invalidate_doc(doc_id)
+    return result
 
 
 def delete_doc_by_id(doc_id):
@@ -93,5 +151,7 @@ def delete_doc_by_id(doc_id):
     with get_db_cursor() as cursor:
         if cursor:
             cursor.execute("UPDATE documents SET active = %s WHERE doc_id = %s", (False, doc_id,))
+            invalidate_vector_store(doc_id)
+            invalidate_doc(doc_id)
             return cursor.rowcount == 1
     return False
@@ -1,10 +1,11 @@
 import json
 
 
-def DocumentsToStr(documents):
+def DocumentsToStr(documents, title=None):
     """
     Convert a list of documents to a string
     :param documents:
+    :param title: name of the document shown for every source, the name in the index otherwise
     :return:
     """
     sources = []
@@ -15,13 +16,13 @@ def DocumentsToStr(documents):
         source = source.replace("'", "''")
         source = source.replace('"', '""')
 
-        title = documents[i].metadata["source"].split("/")[-1]
+        source_title = title or documents[i].metadata["source"].split("/")[-1]
         # if "page" in documents[i]["metadata"]:
         #     title = title + ": " + documents[i]["metadata"]["page"]
 
         sources.append({
             "source": source,
-            "title": title
+            "title": source_title
         })
 
     # serialize the sources
@@ -2,7 +2,20 @@
 import time
 import pandas as pd
 
-from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one
+from cocroach_utils.conv_cache import add_turn, invalidate_convs
+from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one, build_page_query, fetch_page, \
+    update_fields, insert_rows
+
+history_columns = {
+    "hist_id": "hist_id",
+    "conv_id": "conv_id",
+    "prompt": "prompt",
+    "answer": "answer",
+    "feedback": "feedback",
+    "time": "time",
+    "followup": "followup",
+}
+history_key = ("time", "hist_id")
 
 
 def delete_user(user_id):
@@ -18,80 +31,150 @@ def delete_user(user_id):
     return False
 
 
-def get_history_for_conv(conversation_id, limit=10):
+def get_history_for_conv(conversation_id, limit=10, native=False):
     """
     Get history for conversation
     :param conversation_id:
     :param limit:
+    :param native: keep the database types
     :return:
     """
     with get_db_cursor() as cursor:
         if cursor:
             return fetch_all(cursor, "SELECT * FROM history WHERE conv_id = %s ORDER BY time DESC LIMIT %s",
-                             (conversation_id, limit))
+                             (conversation_id, limit), native)
     return []
 
 
-def get_selected_history(history_id):
+def get_history_page(conversation_id, limit=10, page_token=None, columns=None, compact=False):
+    """
+    Get one page of the history of the conversation, from the newest turn to the oldest one
+    :param conversation_id:
+    :param limit: rows in the page
+    :param page_token: next_page_token of the previous page
+    :param columns: columns to return, all if empty
+    :param compact: rows as lists of values with one list of columns
+    :return: dict with the rows and next_page_token
+    """
+    query, params = build_page_query("history", history_columns, columns, history_key, "conv_id = %s",
+                                     (conversation_id,), page_token, limit)
+    with get_db_cursor(dict_rows=not compact) as cursor:
+        if cursor:
+            return fetch_page(cursor, query, params, history_key)
+    return {"rows": [], "next_page_token": None}
+
+
+def get_history_since(conversation_id, since=None):
+    """
+    Get the turns of the conversation after the given time, from oldest to newest
+    :param conversation_id:
+    :param since: None for all the turns
+    :return:
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            if since is None:
+                return fetch_all(cursor, "SELECT prompt, answer, time FROM history WHERE conv_id = %s "
+                                         "ORDER BY time, hist_id", (conversation_id,), native=True)
+            return fetch_all(cursor, "SELECT prompt, answer, time FROM history WHERE conv_id = %s AND time > %s "
+                                     "ORDER BY time, hist_id", (conversation_id, since), native=True)
+    return []
+
+
+def get_selected_history(history_id, native=False):
     """
     Get selected history
     :param history_id:
+    :param native: keep the database types, NULL stays None
     :return:
     """
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_one(cursor, "SELECT * FROM history WHERE conv_id = %s", (history_id,))
+            return fetch_one(cursor, "SELECT * FROM history WHERE hist_id = %s", (history_id,), native=native)
     return []
 
 
-def add_history(conv_id, prompt, answer, followup=None, feedback=0):
+def add_history(conv_id, prompt, answer, followup='', feedback=0):
     """
-    Add history
+    Add history, the turn is also written to the conversation cache
     :param conv_id:
     :param prompt:
     :param answer:
-    :param followup:
+    :param followup: None while the follow up questions are being generated
     :param feedback:
     :return:
     """
-    if followup is None:
-        followup = ''
+    hist_id = -1
+    with get_db_cursor() as cursor:
+        if cursor:
+            hist_id = fetch_one(cursor, "INSERT INTO history (conv_id, prompt, answer, feedback, time, followup) "
+                                        "VALUES (%s, %s, %s, %s, %s, %s) RETURNING hist_id",
+                                (conv_id, prompt, answer, feedback, pd.Timestamp(time.time(), unit='s'),
+                                 followup))['hist_id']
+    if hist_id != -1:
+        add_turn(conv_id, prompt, answer)
+    return hist_id
 
+
+def add_history_bulk(turns):
+    """
+    Add several turns with multi-row inserts in one transaction
+    :param turns: list of dict with conv_id, prompt, answer and optional followup, feedback and time
+    :return: hist_id of every turn, in the same order
+    """
+    now = pd.Timestamp(time.time(), unit='s')
+    rows = [(turn['conv_id'], turn['prompt'], turn['answer'], turn.get('feedback', 0), turn.get('time', now),
+             turn.get('followup') or '') for turn in turns]
+    if not rows:
+        return []
+    hist_ids = []
     with get_db_cursor() as cursor:
         if cursor:
-            return fetch_one(cursor, "INSERT INTO history (conv_id, prompt, answer, feedback, time, followup) VALUES "
-                                     "(%s, %s, %s, %s, %s, %s) RETURNING conv_id",
-                             (conv_id, prompt, answer, feedback, pd.Timestamp(time.time(), unit='s'), followup))['conv_id']
-    return -1
+            hist_ids = insert_rows(cursor, "history", ("conv_id", "prompt", "answer", "feedback", "time", "followup"),
+                                   rows, returning="hist_id")
+    invalidate_convs(turn['conv_id'] for turn in turns)
+    return hist_ids
 
 
 def update_history_field_by_id(history_id, field, value):
     """
-    Update history field by conv_id
+    Update history field by hist_id
     :param history_id:
     :param field:
     :param value:
     :return:
     """
+    return update_history_fields([history_id], {field: value}) == 1
+
+
+def update_history_fields(history_ids, fields):
+    """
+    Update the same fields of several turns in one statement
+    :param history_ids:
+    :param fields: dict field -> value
+    :return: number of updated turns
+    """
+    conv_ids = []
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("UPDATE history SET " + field + " = %s WHERE conv_id = %s",
-                           (value, history_id))
-            return cursor.rowcount == 1
-    return False
+            conv_ids = update_fields(cursor, "history", "hist_id", history_ids, fields, returning="conv_id")
+    invalidate_convs(conv_ids)
+    return len(conv_ids)
 
 
 def delete_history_by_id(history_id):
     """
-    Delete history by conv_id
+    Delete history by hist_id
     :param history_id:
     :return:
     """
+    conv_ids = []
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("DELETE FROM history WHERE conv_id = %s", (history_id,))
-            return cursor.rowcount == 1
-    return False
+            cursor.execute("DELETE FROM history WHERE hist_id = %s RETURNING conv_id", (history_id,))
+            conv_ids = [row['conv_id'] for row in cursor.fetchall()]
+    invalidate_convs(conv_ids)
+    return len(conv_ids) == 1
 
 
 def delete_history_by_conv_id(conv_id):
@@ -100,8 +183,10 @@ def delete_history_by_conv_id(conv_id):
     :param conv_id:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
             cursor.execute("DELETE FROM history WHERE conv_id = %s", (conv_id,))
-            return cursor.rowcount == 1
-    return False
+            result = cursor.rowcount > 0
+    invalidate_convs([conv_id])
+    return result
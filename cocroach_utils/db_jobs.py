@@ -0,0 +1,116 @@
+# This file contains all the functions for the ingest_jobs table (background processing of the uploaded documents)
+# ingest_jobs: job_id, doc_id, user_id, filename, stage, status, error, created, updated
+# stage is the last completed stage: uploaded -> indexed -> summarized
+# status: queued, running, done, error
+import time
+import pandas as pd
+
+from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one
+
+
+def add_job(doc_id, user_id, filename):
+    """
+    Add an ingestion job for the uploaded file and return the new job_id,
+    nothing is added while the document has a queued or running job
+    :param doc_id:
+    :param user_id:
+    :param filename:
+    :return: job_id, None if the document already has an active job, -1 on error
+    """
+    now = pd.Timestamp(time.time(), unit='s')
+    with get_db_cursor() as cursor:
+        if cursor:
+            job = fetch_one(cursor, "INSERT INTO ingest_jobs (doc_id, user_id, filename, stage, status, created, "
+                                    "updated) SELECT %s, %s, %s, %s, %s, %s, %s WHERE NOT EXISTS ("
+                                    "SELECT 1 FROM ingest_jobs WHERE doc_id = %s AND status IN ('queued', 'running')) "
+                                    "RETURNING job_id",
+                            (doc_id, user_id, filename, "uploaded", "queued", now, now, doc_id))
+            if job is not None:
+                return job['job_id'] if job else None
+    return -1
+
+
+def get_active_job(doc_id):
+    """
+    Get the queued or running job of the document
+    :param doc_id:
+    :return: the job or None
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            return fetch_one(cursor, "SELECT * FROM ingest_jobs WHERE doc_id = %s AND status IN ('queued', 'running') "
+                                     "ORDER BY created DESC LIMIT 1", (doc_id,)) or None
+    return None
+
+
+def get_job_by_id(job_id):
+    """
+    Get job by job_id
+    :param job_id:
+    :return:
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            return fetch_one(cursor, "SELECT * FROM ingest_jobs WHERE job_id = %s", (job_id,))
+    return None
+
+
+def get_resumable_jobs(lease):
+    """
+    Get the jobs that are queued or were left running by a stopped worker
+    :param lease: seconds after which a running job is considered abandoned
+    :return:
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            return fetch_all(cursor, "SELECT * FROM ingest_jobs WHERE status = 'queued' "
+                                     "OR (status = 'running' AND updated < %s) ORDER BY created",
+                             (pd.Timestamp(time.time() - lease, unit='s'),))
+    return []
+
+
+def claim_job(job_id, lease):
+    """
+    Mark the job as running if nobody else is working on it
+    :param job_id:
+    :param lease: seconds after which a running job is considered abandoned
+    :return: the job or None if it was claimed by another worker
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            job = fetch_one(cursor, "UPDATE ingest_jobs SET status = 'running', updated = %s WHERE job_id = %s "
+                                    "AND (status = 'queued' OR (status = 'running' AND updated < %s)) RETURNING *",
+                            (pd.Timestamp(time.time(), unit='s'), job_id, pd.Timestamp(time.time() - lease, unit='s')))
+            return job or None
+    return None
+
+
+def renew_jobs(job_ids):
+    """
+    Extend the lease of the running jobs of this worker
+    :param job_ids:
+    :return: number of renewed jobs
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            cursor.execute("UPDATE ingest_jobs SET updated = %s WHERE job_id = ANY(%s) AND status = 'running'",
+                           (pd.Timestamp(time.time(), unit='s'), list(job_ids)))
+            return cursor.rowcount
+    return 0
+
+
+def update_job(job_id, stage, status, error=""):
+    """
+    Save the progress of the job
+    :param job_id:
+    :param stage:
+    :param status:
+    :param error:
+    :return:
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            cursor.execute("UPDATE ingest_jobs SET stage = %s, status = %s, error = %s, updated = %s WHERE job_id = %s",
+                           (stage, status, error, pd.Timestamp(time.time(), unit='s'), job_id))
+            return cursor.rowcount == 1
+    return False
@@ -1,9 +1,10 @@
+from cocroach_utils.catalog_cache import get_cached, invalidate_catalog
 from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one
 
 
-def get_all_models():
+def query_all_models():
     """
-    Get all models
+    Get all models from the database
     :return:
     """
     with get_db_cursor() as cursor:
@@ -12,9 +13,9 @@ def get_all_models():
     return []
 
 
-def get_model_by_id(model_id):
+def query_model_by_id(model_id):
     """
-    Get model by conv_id
+    Get model by model_id from the database
     :param model_id:
     :return:
     """
@@ -24,6 +25,23 @@ def get_model_by_id(model_id):
     return None
 
 
+def get_all_models():
+    """
+    Get all models, cached
+    :return:
+    """
+    return get_cached(("models",), query_all_models)
+
+
+def get_model_by_id(model_id):
+    """
+    Get model by model_id, cached
+    :param model_id:
+    :return:
+    """
+    return get_cached(("model", str(model_id)), lambda: query_model_by_id(model_id))
+
+
 def get_model_by_name(model_name):
     """
     Get model by name
@@ -45,12 +63,15 @@ def add_model(name, description="", price_in=0.0, price_out=0.0):
     :param price_out:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
             cursor.execute("INSERT INTO models (name, description, price_in, price_out) VALUES (%s, %s, %s, "
                            "%s)", (name, description, price_in, price_out))
-            return cursor.rowcount == 1
-    return False
+            result = cursor.rowcount == 1
+    if result:
+        invalidate_catalog()
+    return result
 
 
 def update_model(model_id, name, description="", price_in=0.0, price_out=0.0):
@@ -63,17 +84,23 @@ def update_model(model_id, name, description="", price_in=0.0, price_out=0.0):
     :param price_out:
     :return:
     """
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
             cursor.execute("UPDATE models SET name = %s, description = %s, price_in = %s, price_out = %s "
                            "WHERE model_id = %s", (name, description, price_in, price_out, model_id))
-            return cursor.rowcount == 1
-    return False
+            result = cursor.rowcount == 1
+    if result:
+        invalidate_catalog()
+    return result
 
 
 def delete_model(model_id):
+    result = False
     with get_db_cursor() as cursor:
         if cursor:
             cursor.execute("DELETE FROM models WHERE model_id = %s", (model_id,))
-            return cursor.rowcount == 1
-    return False
+            result = cursor.rowcount == 1
+    if result:
+        invalidate_catalog()
+    return result
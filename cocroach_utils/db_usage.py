@@ -0,0 +1,48 @@
+# This file contains all the functions for the usage table (tokens and cost by user, model and day)
+# usage: user_id, model, day, prompt_tokens, completion_tokens, calls, cost
+from psycopg2.extras import execute_values
+
+from cocroach_utils.database_utils import get_db_cursor, fetch_all
+
+
+def add_usage(rows):
+    """
+    Add the usage totals to the day of the users and models, and the tokens to users.tokens_used, in one transaction
+    :param rows: tuples of user_id, model, prompt_tokens, completion_tokens, calls, cost
+    :return: True if saved
+    """
+    result = False
+    with get_db_cursor() as cursor:
+        if cursor:
+            execute_values(cursor,
+                           "INSERT INTO usage (user_id, model, day, prompt_tokens, completion_tokens, calls, cost) "
+                           "VALUES %s ON CONFLICT (user_id, model, day) DO UPDATE SET "
+                           "prompt_tokens = usage.prompt_tokens + excluded.prompt_tokens, "
+                           "completion_tokens = usage.completion_tokens + excluded.completion_tokens, "
+                           "calls = usage.calls + excluded.calls, cost = usage.cost + excluded.cost",
+                           rows, template="(%s, %s, current_date(), %s, %s, %s, %s)")
+
+            tokens = {}
+            for user_id, model, prompt_tokens, completion_tokens, calls, cost in rows:
+                tokens[user_id] = tokens.get(user_id, 0) + prompt_tokens + completion_tokens
+            execute_values(cursor,
+                           "UPDATE users SET tokens_used = users.tokens_used + totals.tokens "
+                           "FROM (VALUES %s) AS totals (user_id, tokens) WHERE users.user_id = totals.user_id",
+                           list(tokens.items()), template="(%s::INT8, %s::INT8)")
+            result = True
+    return result
+
+
+def get_user_usage(user_id, days=30):
+    """
+    Get the usage of the user by model and day
+    :param user_id:
+    :param days: number of days from today
+    :return:
+    """
+    with get_db_cursor() as cursor:
+        if cursor:
+            return fetch_all(cursor, "SELECT model, day, prompt_tokens, completion_tokens, calls, cost FROM usage "
+                                     "WHERE user_id = %s AND day > current_date() - %s::INT8 "
+                                     "ORDER BY day DESC, model", (user_id, days), native=True)
+    return []
@@ -1,5 +1,5 @@
 # This file contains all the functions related to the users table in the database
-from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one
+from cocroach_utils.database_utils import get_db_cursor, fetch_all, fetch_one, update_fields
 
 
 def get_user_by_id(user_id):
@@ -97,8 +97,7 @@ def update_user_field(user_id, field, value):
     """
     with get_db_cursor() as cursor:
         if cursor:
-            cursor.execute("UPDATE users SET " + field + " = %s WHERE user_id = %s", (value, user_id))
-            return cursor.rowcount == 1
+            return update_fields(cursor, "users", "user_id", [user_id], {field: value}) == 1
     return False
 
 
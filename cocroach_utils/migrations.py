@@ -0,0 +1,236 @@
+# Versioned schema of the CockroachDB tables and the indexes of the hot queries.
+# Every migration runs once, in order, and is recorded in the schema_migrations table.
+# Run with: python -m cocroach_utils.migrations [--verify]
+import sys
+
+from cocroach_utils.database_utils import get_db_cursor, fetch_all, save_error
+
+# tables of a new database, the ids of the time-ordered tables are hash-sharded so the inserts
+# are spread over the ranges instead of always hitting the last one
+create_tables = [
+    "CREATE TABLE IF NOT EXISTS users ("
+    "user_id INT8 NOT NULL DEFAULT unique_rowid() PRIMARY KEY, "
+    "name STRING, email STRING, password STRING, active BOOL NOT NULL DEFAULT true, "
+    "tokens_used INT8 NOT NULL DEFAULT 0, last_active TIMESTAMP)",
+
+    "CREATE TABLE IF NOT EXISTS models ("
+    "model_id INT8 NOT NULL DEFAULT unique_rowid() PRIMARY KEY, "
+    "name STRING, description STRING, price_in FLOAT8 NOT NULL DEFAULT 0, price_out FLOAT8 NOT NULL DEFAULT 0)",
+
+    "CREATE TABLE IF NOT EXISTS assistants ("
+    "assist_id INT8 NOT NULL DEFAULT unique_rowid() PRIMARY KEY, "
+    "name STRING, description STRING, welcome STRING, system_prompt STRING, user_id INT8)",
+
+    "CREATE TABLE IF NOT EXISTS documents ("
+    "doc_id INT8 NOT NULL DEFAULT unique_rowid() PRIMARY KEY, "
+    "user_id INT8, name STRING, summary STRING, summary_steps STRING, updated TIMESTAMP, "
+    "active BOOL NOT NULL DEFAULT true, content_hash STRING)",
+
+    "CREATE TABLE IF NOT EXISTS conversations ("
+    "conv_id INT8 NOT NULL DEFAULT unique_rowid() PRIMARY KEY, "
+    "user_id INT8, doc_id INT8, title STRING, active BOOL NOT NULL DEFAULT true, summary STRING, "
+    "model INT8, assistant INT8, memory INT8 NOT NULL DEFAULT 10)",
+
+    "CREATE TABLE IF NOT EXISTS history ("
+    "hist_id INT8 NOT NULL DEFAULT unique_rowid(), "
+    "conv_id INT8, prompt STRING, answer STRING, feedback INT8 NOT NULL DEFAULT 0, time TIMESTAMP, followup STRING, "
+    "PRIMARY KEY (hist_id) USING HASH)",
+
+    "CREATE TABLE IF NOT EXISTS ingest_jobs ("
+    "job_id INT8 NOT NULL DEFAULT unique_rowid() PRIMARY KEY, "
+    "doc_id INT8, user_id INT8, filename STRING, stage STRING, status STRING, error STRING, "
+    "created TIMESTAMP, updated TIMESTAMP)",
+
+    "CREATE TABLE IF NOT EXISTS errors ("
+    "error_id INT8 NOT NULL DEFAULT unique_rowid(), "
+    "error_text STRING, metadata STRING, time TIMESTAMP NOT NULL DEFAULT now(), "
+    "PRIMARY KEY (error_id) USING HASH)",
+]
+
+# columns added to the tables after the first databases were created by hand
+add_columns = [
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS summary_steps STRING",
+    "ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash STRING",
+]
+
+# covering indexes of the hot queries
+create_indexes = [
+    "CREATE INDEX IF NOT EXISTS history_conv_time_idx ON history (conv_id, time DESC, hist_id DESC) "
+    "STORING (prompt, answer, feedback, followup)",
+    "CREATE INDEX IF NOT EXISTS documents_name_idx ON documents (name)",
+    "CREATE INDEX IF NOT EXISTS documents_user_active_idx ON documents (user_id, active, doc_id DESC) "
+    "STORING (name, summary, updated, content_hash)",
+    "CREATE INDEX IF NOT EXISTS documents_content_hash_idx ON documents (content_hash)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS users_email_key ON users (email)",
+    "CREATE INDEX IF NOT EXISTS conversations_user_idx ON conversations (user_id, conv_id DESC) "
+    "STORING (doc_id, title, active, summary, model, assistant, memory)",
+    "CREATE INDEX IF NOT EXISTS ingest_jobs_status_idx ON ingest_jobs (status, created)",
+]
+
+
+def add_history_id():
+    """
+    Give an id to the history rows of the databases created without it
+    :return:
+    """
+    with get_db_cursor(raise_errors=True) as cursor:
+        cursor.execute("SELECT 1 FROM information_schema.columns "
+                       "WHERE table_name = 'history' AND column_name = 'hist_id'")
+        if cursor.fetchone():
+            return
+        cursor.execute("ALTER TABLE history ADD COLUMN hist_id INT8 NOT NULL DEFAULT unique_rowid()")
+    # the column must be committed before it is indexed
+    with get_db_cursor(raise_errors=True) as cursor:
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS history_hist_id_key ON history (hist_id) USING HASH")
+
+
+# versions of the cached tables, read by every worker to know when to clear its cache
+create_cache_versions = [
+    "CREATE TABLE IF NOT EXISTS cache_versions ("
+    "name STRING NOT NULL PRIMARY KEY, version INT8 NOT NULL DEFAULT 0)",
+]
+
+
+# rolling summary of the older turns of the conversations
+add_summary_until = [
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary_until TIMESTAMP",
+]
+
+
+# tokens and cost by user, model and day
+create_usage = [
+    "CREATE TABLE IF NOT EXISTS usage ("
+    "user_id INT8 NOT NULL, model STRING NOT NULL, day DATE NOT NULL, "
+    "prompt_tokens INT8 NOT NULL DEFAULT 0, completion_tokens INT8 NOT NULL DEFAULT 0, "
+    "calls INT8 NOT NULL DEFAULT 0, cost FLOAT8 NOT NULL DEFAULT 0, "
+    "PRIMARY KEY (user_id, model, day))",
+]
+
+
+# version, description, steps: sql statements or functions
+migrations = [
+    (1, "create tables", create_tables),
+    (2, "add new columns", add_columns + [add_history_id]),
+    (3, "create indexes of the hot queries", create_indexes),
+    (4, "create cache versions", create_cache_versions),
+    (5, "add summary_until to conversations", add_summary_until),
+    (6, "create usage", create_usage),
+]
+
+# name, query, params, indexes that the plan must use
+hot_queries = [
+    ("history of the conversation",
+     "SELECT prompt, answer, time FROM history WHERE conv_id = %s ORDER BY time DESC, hist_id DESC LIMIT %s",
+     (0, 10), ("history_conv_time_idx",)),
+    ("history by id",
+     "SELECT * FROM history WHERE hist_id = %s",
+     (0,), ("history_pkey", "history_hist_id_key")),
+    ("document by name",
+     "SELECT * FROM documents WHERE name = %s",
+     ("",), ("documents_name_idx",)),
+    ("documents of the user",
+     "SELECT * FROM documents WHERE user_id = %s AND active = true ORDER BY doc_id DESC LIMIT %s",
+     (0, 10), ("documents_user_active_idx",)),
+    ("document by hash",
+     "SELECT * FROM documents WHERE content_hash = %s AND active = true",
+     ("",), ("documents_content_hash_idx",)),
+    ("user by email",
+     "SELECT * FROM users WHERE email = %s",
+     ("",), ("users_email_key",)),
+    ("conversations of the user",
+     "SELECT conv_id, title FROM conversations WHERE user_id = %s ORDER BY conv_id DESC LIMIT %s",
+     (0, 10), ("conversations_user_idx",)),
+]
+
+
+def get_applied_versions():
+    """
+    Get the versions of the applied migrations, the table of the versions is created the first time
+    :return:
+    """
+    with get_db_cursor(raise_errors=True) as cursor:
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_migrations ("
+                       "version INT8 NOT NULL PRIMARY KEY, description STRING, "
+                       "applied TIMESTAMP NOT NULL DEFAULT now())")
+    with get_db_cursor(raise_errors=True) as cursor:
+        return {row['version'] for row in fetch_all(cursor, "SELECT version FROM schema_migrations", native=True)}
+
+
+def run_migrations():
+    """
+    Apply the migrations that are not applied yet.
+    Every step is committed on its own since CockroachDB runs schema changes in the background,
+    all the statements are idempotent so a failed migration can be run again.
+    A failed step raises, its version and the next ones are not recorded.
+    :return: versions applied now
+    """
+    applied = get_applied_versions()
+    done = []
+    for version, description, steps in migrations:
+        if version in applied:
+            continue
+        for step in steps:
+            if callable(step):
+                step()
+                continue
+            with get_db_cursor(raise_errors=True) as cursor:
+                cursor.execute(step)
+        with get_db_cursor(raise_errors=True) as cursor:
+            cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                           (version, description))
+        print(f"migration {version} applied: {description}")
+        done.append(version)
+    return done
+
+
+def get_pending_versions():
+    """
+    Get the versions of the migrations not applied yet
+    :return:
+    """
+    applied = get_applied_versions()
+    return [version for version, description, steps in migrations if version not in applied]
+
+
+def explain_query(query, params):
+    """
+    Get the plan of the query
+    :param query:
+    :param params:
+    :return: lines of the plan
+    """
+    with get_db_cursor(dict_rows=False, raise_errors=True) as cursor:
+        cursor.execute("EXPLAIN " + query, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def verify_indexes():
+    """
+    Check with EXPLAIN that the hot queries use their indexes and do not scan the whole table
+    :return: list of dict with name, status and plan
+    """
+    report = []
+    for name, query, params, indexes in hot_queries:
+        try:
+            plan = explain_query(query, params)
+        except Exception as e:
+            save_error(e, name)
+            report.append({"name": name, "status": "error", "plan": [str(e)]})
+            continue
+        text = "\n".join(plan)
+        uses_index = any(index in text for index in indexes)
+        status = "ok" if uses_index and "FULL SCAN" not in text else "missing index"
+        report.append({"name": name, "status": status, "plan": plan})
+    return report
+
+
+if __name__ == "__main__":
+    run_migrations()
+    if "--verify" in sys.argv:
+        failed = 0
+        for result in verify_indexes():
+            print(f"{result['status']}: {result['name']}")
+            if result['status'] != "ok":
+                failed += 1
+                print("\n".join(result['plan']))
+        sys.exit(1 if failed else 0)
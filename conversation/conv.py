@@ -1,60 +1,108 @@
+import asyncio
 import os
 
 from dotenv import load_dotenv
 from langchain import LLMChain, PromptTemplate
-from langchain.chains.summarize import load_summarize_chain
+from langchain.callbacks import AsyncIteratorCallbackHandler
 
-from langchain.chat_models import ChatOpenAI
 from langchain.prompts import SystemMessagePromptTemplate, HumanMessagePromptTemplate, ChatPromptTemplate, \
     MessagesPlaceholder
-from langchain.text_splitter import TokenTextSplitter
-from langchain.vectorstores import Chroma
 from langchain.chains import RetrievalQA
 from langchain.memory import ConversationBufferMemory
 
-from cocroach_utils.database_utils import save_error
+from cocroach_utils.conv_cache import cache_turns
+from cocroach_utils.database_utils import save_error, run_db
 from cocroach_utils.db_helper import DocumentsToStr
-from cocroach_utils.db_history import add_history, get_history_for_conv
-from cocroach_utils.db_docs import get_doc_by_id, update_doc_field_by_id
-from conversation.conv_helper import get_conv_id, format_response
-
+from cocroach_utils.db_context import get_turn_context
+from cocroach_utils.db_history import add_history, get_selected_history, update_history_field_by_id
+from cocroach_utils.db_docs import update_doc_field_by_id
+from conversation.conv_helper import format_response, AnswerStream
+from conversation.llm_cache import CachedChatOpenAI
+from conversation.doc_summary import summarize_texts, reduce_summaries
+from conversation.memory import select_turns, format_summary, schedule_summary_update
+from utils.async_utils import run_blocking
+from utils.metering import UsageCallbackHandler
+
+from vectordb.answer_cache import get_cached_answer, set_cached_answer, get_answer_generation
+from vectordb.parsed_doc import parse_document, split_parsed_document
+from vectordb.store_cache import get_vector_store
 from vectordb.vectordb import get_embedding_model
 from vectordb.vectordb import get_loader
 
 load_dotenv()
 model_name = ["gpt-3.5-turbo", "gpt-3.5-turbo-16k"]
 persist_directory = './db'
+# seconds /history/follow_up waits for follow up questions still being generated
+follow_up_wait = float(os.getenv("FOLLOW_UP_WAIT", 30))
+# the answer over the document also writes the follow up questions, instead of a second llm call
+single_call_follow_up = os.getenv("DOC_SINGLE_CALL_FOLLOW_UP", "false") == "true"
+# start the "NONE" fallback while the first answer over the document is still running, and its answer without
+# the document with the one over the document, opt-in since the calls that lose are billed too. Without it a "NONE"
+# costs up to four serial calls (first answer, prompt rewrite, answer over the document, answer without it),
+# DOC_LATENCY_BUDGET still caps the turn, with it the turn takes about two calls
+speculative_fallback = os.getenv("FALLBACK_SPECULATIVE", "false") == "true"
+# seconds the first answer runs alone before the speculative fallback starts, about its median latency,
+# so only the slow first answers pay for the speculation
+speculation_delay = float(os.getenv("FALLBACK_SPECULATION_DELAY", 3))
+# seconds allowed for the answer of a turn over a document, fallback included
+latency_budget = float(os.getenv("DOC_LATENCY_BUDGET", 60))
+follow_up_instructions = """After the answer, write "FOLLOW UP QUESTIONS:" on a new line, then three short questions
+                        the user could ask next about the document, one per line. Do not add them if you reply "NONE"."""
+
+# follow up questions being generated by this worker, by history id as str
+follow_up_tasks = {}
+
+
+def get_llm(model, streaming=False, callbacks=None, user_id=None, site="default", cache_bypass=False):
+    """
+    Get the chat model, the tokens of its calls are metered for the user and its answers are cached on disk
+    :param model: name of the model, the default one if the conversation has none
+    :param streaming: send the tokens to the callbacks as they arrive
+    :param callbacks:
+    :param user_id:
+    :param site: name of the call site in the llm cache counters
+    :param cache_bypass: always call the API
+    :return:
+    """
+    model = model or model_name[0]
+    callbacks = list(callbacks or []) + [UsageCallbackHandler(user_id, model)]
+    return CachedChatOpenAI(temperature=.0, model_name=model, verbose=False, streaming=streaming, callbacks=callbacks,
+                            cache_site=site, cache_bypass=cache_bypass)
 
-llm = ChatOpenAI(temperature=.0, model_name=model_name[0], verbose=False, model_kwargs={"stream": False})
 
-def get_doc_summary(file, doc_id, chunk_size=2048, chunk_overlap=64):
-    if file.filename == '':
+def get_turn_llm(context, streaming=False, callbacks=None, site="answer"):
+    """
+    Get the chat model of the conversation, metered for its user
+    :param context: context of the turn
+    :param streaming:
+    :param callbacks:
+    :param site: name of the call site in the llm cache counters
+    :return:
+    """
+    return get_llm(context['model'], streaming=streaming, callbacks=callbacks, user_id=context['user_id'], site=site)
+
+
+def get_doc_summary(filename, doc_id, chunk_size=2048, chunk_overlap=64, user_id=None):
+    if not filename:
         return {
             "status": "error",
             "message": "No file selected"
         }
-    filename = f"./data/{file.filename}"
     loader = get_loader(filename)
-    documents = loader.load()
-    text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
-                                      encoding_name="cl100k_base")
-    docs = text_splitter.split_documents(documents)
-
-    prompt_template = """Write a concise and condensed summary of the following:
-
-    {text}
-
-    CONCISE SUMMARY:"""
-
-    prompttemplate = PromptTemplate(template=prompt_template, input_variables=["text"])
-    chain = load_summarize_chain(llm, chain_type="map_reduce", return_intermediate_steps=True,
-                                 map_prompt=prompttemplate, combine_prompt=prompttemplate)
+    if loader is None:
+        return {
+            "status": "error",
+            "message": "File format is not supported"
+        }
+    # same parse as the vector index, only the chunk size differs
+    docs = split_parsed_document(parse_document(filename, loader), chunk_size, chunk_overlap)
 
     try:
-        summary = chain({"input_documents": docs}, return_only_outputs=True)
-        intermediate_steps = summary['intermediate_steps']
-        intermediate_steps = "\n".join(intermediate_steps)
-        result = summary['output_text']
+        # map: summaries of the chunks in parallel, reduce: combine them level by level
+        summary_llm = get_llm(model_name[0], user_id=user_id, site="doc_summary")
+        steps = summarize_texts(summary_llm, [doc.page_content for doc in docs])
+        intermediate_steps = "\n".join(steps)
+        result = reduce_summaries(summary_llm, steps)
         update_doc_field_by_id(doc_id, "summary", result)
         try:
             update_doc_field_by_id(doc_id, "summary_steps", intermediate_steps)
@@ -78,66 +126,207 @@ def get_doc_summary(file, doc_id, chunk_size=2048, chunk_overlap=64):
         }
 
 
-def get_simple_response(prompt, conv_id, user_id, memory=10):
+async def load_turn_context(conv_id, doc_id, memory):
     """
-    Get a simple response from the model
-    :param memory:
-    :param user_id:
-    :param prompt:
+    Load the conversation, its model, the document and the last turns in one database round trip,
+    the history keeps the most recent turns that fit in the token budget of the model
+    :param conv_id:
+    :param doc_id:
+    :param memory: maximum number of turns, 0 or -1 to answer without the history
+    :return: context of the turn, history from oldest to newest, or None if the conversation does not exist
+    """
+    if conv_id is None or conv_id == -1 or conv_id == 0:
+        return None
+    limit = min(memory, cache_turns) if memory > 0 else 0
+    context = await run_db(get_turn_context, conv_id, doc_id, limit)
+    if not context:
+        await run_db(save_error, "Conversation not found")
+        return None
+
+    context["model"] = context["model"] or model_name[0]
+    # from last to first
+    history = list(reversed(context["history"] or []))
+    context["history"] = select_turns(history, context["model"], memory)
+    if memory > 0:
+        # the turns left out of the next prompt go to the rolling summary
+        context["keep"] = len(context["history"]) + 1
+    else:
+        # without the history the summary is neither in the prompt nor updated
+        context["summary"] = None
+        context["keep"] = None
+    context["doc"] = {
+        "name": context["doc_name"] or "",
+        "summary": context["doc_summary"] or "",
+    }
+    return context
+
+
+def update_memory(conv_id, context):
+    """
+    Add the turns that do not fit in the prompt anymore to the rolling summary, in the background
     :param conv_id:
+    :param context: context of the turn
     :return:
     """
+    if context["keep"] is not None:
+        schedule_summary_update(get_llm(model_name[0], user_id=context["user_id"], site="memory_summary"), conv_id,
+                                context["summary"], context["summary_until"], context["keep"])
 
-    cur_conv = get_conv_id(conv_id, user_id, 0)
-    if cur_conv == -1:
-        return {
-            "status": "error",
-            "message": "Conversation not found or can't be created",
-            "conversation_id": conv_id
-        }
 
-    template = """You are a chatbot having a conversation with a human.
+def fill_memory(memory_obj, history):
+    """
+    Load the conversation turns into the chain memory
+    :param memory_obj:
+    :param history:
+    :return:
+    """
+    for hist in history:
+        memory_obj.save_context(
+            {"question": hist["prompt"]},
+            {"output": hist["answer"]}
+        )
+    return memory_obj
 
+
+def get_simple_chain(history, summary, cur_llm):
+    """
+    Build the chain for a simple conversation
+    :param history:
+    :param summary: rolling summary of the older turns
+    :param cur_llm:
+    :return:
+    """
+    template = """You are a chatbot having a conversation with a human.
+    {summary}
     {chat_history}
     Human: {human_input}
     Chatbot:"""
 
     prompt_template = PromptTemplate(
-        input_variables=["chat_history", "human_input"], template=template
+        input_variables=["chat_history", "human_input"], template=template,
+        partial_variables={"summary": format_summary(summary)}
     )
     memory_obj = ConversationBufferMemory(memory_key="chat_history")
+    fill_memory(memory_obj, history)
 
-    if memory != -1:
-        # get history from db
-        history = get_history_for_conv(conv_id, 2)
-        if history is not None:
-            # from last to first
-            history.reverse()
-            for hist in history:
-                memory_obj.save_context(
-                    {"question": hist["prompt"]},
-                    {"output": hist["answer"]})
-
-    cur_llm = ChatOpenAI(temperature=.0, model_name=cur_conv['model'], verbose=False, model_kwargs={"stream": False})
-
-    chain = LLMChain(
+    return LLMChain(
         llm=cur_llm,
         prompt=prompt_template,
         verbose=True,
         memory=memory_obj,
     )
 
+
+async def get_doc_chain(doc_id, history, summary, cur_llm):
+    """
+    Build the retrieval chain over the document index
+    :param doc_id:
+    :param history:
+    :param summary: rolling summary of the older turns
+    :param cur_llm:
+    :return:
+    """
+    docsearch = await run_blocking(get_vector_store, doc_id, get_embedding_model())
+
+    _DEFAULT_TEMPLATE = """Use the following context (delimited by <ctx></ctx>) and the chat history (delimited by <hs></hs>) to answer the question:
+                        If you don't know the answer, reply "NONE".
+                        Always reply in the Markdown format.
+                        {follow_up}
+                        =========
+                        ------
+                        <ctx>
+                        {context}
+                        </ctx>
+                        ------
+                        <hs>
+                        {summary}
+                        {history}
+                        </hs>
+                        ------
+                        {question}
+                        Answer: """
+
+    promptTmp = PromptTemplate(
+        input_variables=["history", "context", "question"],
+        template=_DEFAULT_TEMPLATE,
+        partial_variables={
+            "summary": format_summary(summary),
+            "follow_up": follow_up_instructions if single_call_follow_up else "",
+        },
+    )
+
+    retriever = docsearch.as_retriever()
+
+    memory_obj = ConversationBufferMemory(
+        memory_key="history",
+        input_key="question")
+    fill_memory(memory_obj, history)
+
+    return RetrievalQA.from_chain_type(
+        llm=cur_llm,
+        chain_type="stuff",
+        retriever=retriever,
+        return_source_documents=True,
+        verbose=False,
+        chain_type_kwargs={
+            "prompt": promptTmp,
+            "memory": memory_obj,
+        }
+    )
+
+
+def conversation_not_found(conv_id):
+    """
+    Error result for a missing conversation
+    :param conv_id:
+    :return:
+    """
+    return {
+        "status": "error",
+        "message": "Conversation not found or can't be created",
+        "conversation_id": conv_id
+    }
+
+
+async def get_simple_response(prompt, conv_id, user_id, memory=10):
+    """
+    Get a simple response from the model
+    :param memory:
+    :param user_id:
+    :param prompt:
+    :param conv_id:
+    :return:
+    """
+
+    context = await load_turn_context(conv_id, None, memory)
+    if context is None:
+        return conversation_not_found(conv_id)
+
+    chain = get_simple_chain(context["history"], context["summary"], get_turn_llm(context, site="simple"))
+
     try:
-        response = chain.predict(human_input=prompt)
-        hist_id = add_history(conv_id, prompt, response, "")
+        response = await chain.apredict(human_input=prompt)
+        hist_id = await run_db(add_history, conv_id, prompt, response, "")
+        update_memory(conv_id, context)
     except Exception as e:
-        save_error(e)
+        await run_db(save_error, e)
         return {
             "status": "error",
             "message": str(e),
             "conversation_id":str(conv_id)
         }
 
+    return simple_response_result(response, conv_id, hist_id)
+
+
+def simple_response_result(response, conv_id, hist_id):
+    """
+    Format the result of a simple response
+    :param response:
+    :param conv_id:
+    :param hist_id:
+    :return:
+    """
     return {
         "status": "success",
         "message": "Agent response",
@@ -151,108 +340,183 @@ def get_simple_response(prompt, conv_id, user_id, memory=10):
     }
 
 
-def get_response_over_doc(prompt, conv_id, doc_id, user_id, memory):
-    if doc_id is not None:
+async def stream_simple_response(prompt, conv_id, user_id, memory=10):
+    """
+    Stream a simple response from the model token by token
+    :param prompt:
+    :param conv_id:
+    :param user_id:
+    :param memory:
+    :return: async generator of events, the last one is the same result as get_simple_response
+    """
+    context = await load_turn_context(conv_id, None, memory)
+    if context is None:
+        yield end_event(conversation_not_found(conv_id))
+        return
+
+    handler = AsyncIteratorCallbackHandler()
+    chain = get_simple_chain(context["history"], context["summary"],
+                             get_turn_llm(context, streaming=True, callbacks=[handler], site="simple"))
+
+    task = asyncio.create_task(chain.apredict(human_input=prompt))
+    # stop waiting for tokens if the chain fails before the llm starts
+    task.add_done_callback(lambda _: handler.done.set())
+    try:
+        async for token in handler.aiter():
+            yield token_event(token)
+        response = await task
+        hist_id = await run_db(add_history, conv_id, prompt, response, "")
+        update_memory(conv_id, context)
+    except Exception as e:
+        await run_db(save_error, e)
+        yield end_event({
+            "status": "error",
+            "message": str(e),
+            "conversation_id": str(conv_id)
+        })
+        return
+    finally:
+        task.cancel()
 
-        user_prompt = prompt
-        history = []
+    yield end_event(simple_response_result(response, conv_id, hist_id))
 
-        index_dir = os.path.join(persist_directory, str(doc_id))
-        embeddings = get_embedding_model()
-        docsearch = Chroma(persist_directory=index_dir, embedding_function=embeddings)
 
-        cur_conv = get_conv_id(conv_id, user_id, doc_id)
-        if cur_conv == -1:
-            return {
-                "status": "error",
-                "message": "Conversation not found or can't be created",
-                "conversation_id": conv_id
-            }
+async def get_fallback_answer(prompt, context, chain, delay=0):
+    """
+    Answer the optimized prompt for a first answer "NONE": over the document, and without it if the document has
+    none, both at the same time when the fallback is speculative
+    :param prompt:
+    :param context: context of the turn
+    :param chain: retrieval chain, not the one of the first answer
+    :param delay: seconds to wait before starting
+    :return: result of the retrieval chain and the formatted response
+    """
+    if delay > 0:
+        await asyncio.sleep(delay)
+    history = context["history"]
+    user_prompt = await get_prompt_suggestion_doc(prompt, context["doc"], history, context["user_id"])
+
+    simple_chain = get_simple_chain(history, context["summary"], get_turn_llm(context, site="fallback"))
+    doc_task = asyncio.create_task(chain.acall({"query": user_prompt}))
+    simple_task = None
+    if speculative_fallback:
+        simple_task = create_speculative_task(simple_chain.apredict(human_input=user_prompt))
+    try:
+        result = await doc_task
+        response = format_response(result['result'], single_call_follow_up)
+
+        if response["answer"] == "NONE":
+            # same turn, so the answer without the document is not saved separately
+            if simple_task is None:
+                response["answer"] = await simple_chain.apredict(human_input=user_prompt)
+            else:
+                response["answer"] = await simple_task
+        return result, response
+    finally:
+        doc_task.cancel()
+        if simple_task is not None:
+            simple_task.cancel()
+
+
+def create_speculative_task(coro):
+    """
+    Start a task whose result may never be used, its error is not reported if nobody waits for it
+    :param coro:
+    :return:
+    """
+    task = asyncio.create_task(coro)
+    task.add_done_callback(lambda done: done.cancelled() or done.exception())
+    return task
 
-        _DEFAULT_TEMPLATE = """Use the following context (delimited by <ctx></ctx>) and the chat history (delimited by <hs></hs>) to answer the question:
-                            If you don't know the answer, reply "NONE".
-                            Always reply in the Markdown format.
-                            =========
-                            ------
-                            <ctx>
-                            {context}
-                            </ctx>
-                            ------
-                            <hs>
-                            {history}
-                            </hs>
-                            ------
-                            {question}
-                            Answer: """
-
-        promptTmp = PromptTemplate(
-            input_variables=["history", "context", "question"],
-            template=_DEFAULT_TEMPLATE,
-        )
 
-        retriever = docsearch.as_retriever()
-
-        memory_obj = ConversationBufferMemory(
-            memory_key="history",
-            input_key="question")
-
-        if memory != -1:
-            # get history from db
-            history = get_history_for_conv(conv_id, 2)
-            if history is not None:
-                # from last to first
-                history.reverse()
-                for hist in history:
-                    memory_obj.save_context(
-                        {"question": hist["prompt"]},
-                        {"output": hist["answer"]}
-                    )
-
-        cur_llm = ChatOpenAI(temperature=.0, model_name=cur_conv['model'], verbose=False,
-                             model_kwargs={"stream": False})
-
-        cur_conversation = RetrievalQA.from_chain_type(
-            llm=cur_llm,
-            chain_type="stuff",
-            retriever=retriever,
-            return_source_documents=True,
-            verbose=False,
-            chain_type_kwargs={
-                "prompt": promptTmp,
-                "memory": memory_obj,
-            }
-        )
+def start_fallback(prompt, context, chain):
+    """
+    Start the fallback speculatively, it is cancelled if the first answer is not "NONE"
+    :param prompt:
+    :param context: context of the turn
+    :param chain: retrieval chain, not the one of the first answer
+    :return: task of get_fallback_answer, or None if the fallback only starts after a "NONE"
+    """
+    if not speculative_fallback:
+        return None
+    return create_speculative_task(get_fallback_answer(prompt, context, chain, speculation_delay))
+
+
+async def await_fallback(fallback_task, prompt, context, chain):
+    """
+    Get the fallback answer, from the speculative task if there is one
+    :param fallback_task: task of start_fallback or None
+    :param prompt:
+    :param context: context of the turn
+    :param chain: retrieval chain, not the one of the first answer
+    :return: result of the retrieval chain and the formatted response
+    """
+    if fallback_task is None:
+        return await get_fallback_answer(prompt, context, chain)
+    return await fallback_task
+
+
+async def resolve_doc_answer(first_task, fallback_task, prompt, context, chain):
+    """
+    Wait for the first answer, and for the fallback if it is "NONE"
+    :param first_task: task of the retrieval chain with the prompt
+    :param fallback_task: task of start_fallback or None
+    :param prompt:
+    :param context: context of the turn
+    :param chain: retrieval chain of the fallback
+    :return: result of the retrieval chain and the formatted response
+    """
+    result = await first_task
+    response = format_response(result['result'], single_call_follow_up)
+    if response["answer"] != "NONE":
+        return result, response
+    return await await_fallback(fallback_task, prompt, context, chain)
+
+
+def timeout_result(conv_id):
+    """
+    Error result for a turn over the budget
+    :param conv_id:
+    :return:
+    """
+    return {
+        "status": "error",
+        "message": "No response within the latency budget",
+        "conversation_id": str(conv_id),
+        "data": {
+            "response": f"No response in {latency_budget:g} seconds",
+        }
+    }
 
-        try:
-            result = cur_conversation({"query": user_prompt})
-            response = format_response(result['result'])
-            print("response: ", response)
-
-            if response["answer"] == "NONE":
-                user_prompt = get_prompt_suggestion_doc(user_prompt, doc_id, history)
-                print("user_prompt: ", user_prompt)
-                result = cur_conversation({"query": user_prompt})
-                response = format_response(result['result'])
-                print("response: ", response)
-
-                if response["answer"] == "NONE":
-                    result = get_simple_response(user_prompt, conv_id, user_id, history)
-                    print("result: ", result)
-                    if result["status"] == "success":
-                        response["answer"] = result["message"]
-                    else:
-                        return {
-                            "status": "error",
-                            "message": "Error while getting response",
-                            "conversation_id": str(conv_id),
-                            "data": {
-                                "response": "Error while getting response",
-                            }
-                        }
 
+async def get_response_over_doc(prompt, conv_id, doc_id, user_id, memory):
+    if doc_id is not None:
+
+        user_prompt = prompt
+
+        context = await load_turn_context(conv_id, doc_id, memory)
+        if context is None:
+            return conversation_not_found(conv_id)
+
+        lookup = await find_cached_answer(user_prompt, doc_id)
+        if lookup["cached"] is not None:
+            cached = lookup["cached"]
+            return await save_doc_turn(prompt, conv_id, cached["answer"], cached["source"], cached["follow_up"], True)
 
+        cur_conversation = await get_doc_chain(doc_id, context["history"], context["summary"], get_turn_llm(context))
+        # own chain, so the fallback does not share the memory of the first answer
+        fallback_chain = await get_doc_chain(doc_id, context["history"], context["summary"], get_turn_llm(context))
+
+        first_task = asyncio.create_task(cur_conversation.acall({"query": user_prompt}))
+        fallback_task = start_fallback(user_prompt, context, fallback_chain)
+        try:
+            result, response = await asyncio.wait_for(
+                resolve_doc_answer(first_task, fallback_task, user_prompt, context, fallback_chain), latency_budget)
+        except asyncio.TimeoutError:
+            await run_db(save_error, "No response over the document within the latency budget")
+            return timeout_result(conv_id)
         except Exception as e:
-            save_error(e)
+            await run_db(save_error, e)
             return {
                 "status": "error",
                 "message": "Error while getting response",
@@ -261,98 +525,395 @@ def get_response_over_doc(prompt, conv_id, doc_id, user_id, memory):
                     "response": str(e),
                 }
             }
+        finally:
+            # the losing attempt
+            first_task.cancel()
+            if fallback_task is not None:
+                fallback_task.cancel()
 
-        history.append({
-            "prompt": prompt,
-            "answer": response["answer"]
-        })
+        return await finish_doc_response(prompt, conv_id, doc_id, context, response["answer"],
+                                         result["source_documents"], lookup, response["follow_up_questions"])
 
-        follow_up = get_follow_up_questions_doc(doc_id, history)
+    else:
+        await run_db(save_error, "No document selected")
+        return {
+            "status": "error",
+            "message": "No document selected",
+            "conversation_id": None
+        }
 
-        follow_up_str = "\n".join(follow_up)
-        hist_id = add_history(conv_id, prompt, response["answer"], follow_up_str)
 
-        source = []
-        if result["source_documents"] is not None:
-            source = result["source_documents"]
+async def find_cached_answer(prompt, doc_id):
+    """
+    Look the question up in the semantic answer cache of the document
+    :param prompt:
+    :param doc_id:
+    :return: dict with the generation of the index, the question vector and the cached answer or None
+    """
+    lookup = {
+        "generation": get_answer_generation(doc_id),
+        "vector": None,
+        "cached": None,
+    }
+    try:
+        # the vector is cached, so the retriever does not embed the question again
+        lookup["vector"] = await run_blocking(get_embedding_model().embed_query, prompt)
+        lookup["cached"] = get_cached_answer(doc_id, lookup["vector"])
+    except Exception as e:
+        await run_db(save_error, e)
+    return lookup
 
-        return {
-            "status": "success",
-            "message": "Agent response",
-            "data": {
-                "response": response["answer"],
-                "follow_up_questions": follow_up,
-                "source": DocumentsToStr(result["source_documents"]),
-                "conversation_id": str(conv_id),
-                "history_id": hist_id
-            }
+
+def doc_turn_result(conv_id, hist_id, answer, source, follow_up, follow_up_status="ready", cached=False):
+    """
+    Format the result of a turn over the document
+    :param conv_id:
+    :param hist_id:
+    :param answer:
+    :param source: formatted sources of the answer
+    :param follow_up: list of follow up questions
+    :param follow_up_status: "pending" if the follow up questions come later from /history/follow_up
+    :param cached: True if the answer comes from the answer cache
+    :return:
+    """
+    return {
+        "status": "success",
+        "message": "Agent response",
+        "data": {
+            "response": answer,
+            "follow_up_questions": follow_up,
+            "follow_up_status": follow_up_status,
+            "source": source,
+            "conversation_id": str(conv_id),
+            "history_id": hist_id,
+            "cached": cached
         }
+    }
 
-    else:
-        save_error("No document selected")
-        return {
+
+async def save_doc_turn(prompt, conv_id, answer, source, follow_up, cached=False):
+    """
+    Save the turn with its follow up questions and format the result
+    :param prompt:
+    :param conv_id:
+    :param answer:
+    :param source: formatted sources of the answer
+    :param follow_up: list of follow up questions
+    :param cached: True if the answer comes from the answer cache
+    :return:
+    """
+    hist_id = await run_db(add_history, conv_id, prompt, answer, "\n".join(follow_up))
+    return doc_turn_result(conv_id, hist_id, answer, source, follow_up, cached=cached)
+
+
+async def save_follow_up(hist_id, follow_up_task, on_ready):
+    """
+    Wait for the follow up questions and write them to the turn
+    :param hist_id:
+    :param follow_up_task: task of get_follow_up_questions_doc
+    :param on_ready: called with the questions once they are saved
+    :return: list of follow up questions
+    """
+    try:
+        follow_up = await follow_up_task
+        if hist_id != -1:
+            await run_db(update_history_field_by_id, hist_id, "followup", "\n".join(follow_up))
+        on_ready(follow_up)
+        return follow_up
+    except Exception as e:
+        await run_db(save_error, e)
+        return []
+
+
+def schedule_follow_up(hist_id, follow_up_task, on_ready):
+    """
+    Save the follow up questions in the background, /history/follow_up can wait for them by history id
+    :param hist_id:
+    :param follow_up_task: task of get_follow_up_questions_doc
+    :param on_ready: called with the questions once they are saved
+    :return: task returning the list of follow up questions
+    """
+    task = asyncio.create_task(save_follow_up(hist_id, follow_up_task, on_ready))
+    if hist_id != -1:
+        # also keeps a reference until the task is done
+        key = str(hist_id)
+        follow_up_tasks[key] = task
+        task.add_done_callback(lambda _: follow_up_tasks.pop(key, None))
+    return task
+
+
+async def finish_doc_response(prompt, conv_id, doc_id, context, answer, source_documents, lookup, follow_up=None,
+                              wait_follow_up=False):
+    """
+    Save the turn while the follow up questions are generated, and format the result
+    :param prompt:
+    :param conv_id:
+    :param doc_id:
+    :param context: context of the turn
+    :param answer:
+    :param source_documents:
+    :param lookup: result of find_cached_answer
+    :param follow_up: follow up questions written with the answer, generated separately if empty
+    :param wait_follow_up: wait for the follow up questions, otherwise they come later from /history/follow_up
+    :return:
+    """
+    history = context["history"] + [{
+        "prompt": prompt,
+        "answer": answer
+    }]
+    # the indexes copied from the same file of another upload keep the name of that upload
+    source = DocumentsToStr(source_documents or [], context["doc"]["name"] or None)
+
+    if follow_up:
+        result = await save_doc_turn(prompt, conv_id, answer, source, follow_up)
+        update_memory(conv_id, context)
+        if lookup["vector"] is not None:
+            set_cached_answer(doc_id, lookup["generation"], lookup["vector"], prompt, answer, source, follow_up)
+        return result
+
+    follow_up_task = asyncio.create_task(get_follow_up_questions_doc(context["doc"], history, context["user_id"]))
+    # followup stays NULL until the questions are saved
+    hist_id = await run_db(add_history, conv_id, prompt, answer, None)
+    update_memory(conv_id, context)
+
+    def cache_answer(follow_up):
+        if lookup["vector"] is not None:
+            set_cached_answer(doc_id, lookup["generation"], lookup["vector"], prompt, answer, source, follow_up)
+
+    if hist_id == -1 and not wait_follow_up:
+        # the turn was not saved, nobody can ask for its questions
+        follow_up_task.cancel()
+        return doc_turn_result(conv_id, hist_id, answer, source, [])
+
+    task = schedule_follow_up(hist_id, follow_up_task, cache_answer)
+    if not wait_follow_up:
+        return doc_turn_result(conv_id, hist_id, answer, source, [], "pending")
+    # shielded, the questions are still saved if the client goes away
+    follow_up = await asyncio.shield(task)
+    return doc_turn_result(conv_id, hist_id, answer, source, follow_up)
+
+
+async def get_follow_up_by_history(hist_id):
+    """
+    Get the follow up questions of a turn over a document, waits for them while this worker generates them
+    :param hist_id:
+    :return: dict with follow_up_status and follow_up_questions, or None if the turn does not exist
+    """
+    task = follow_up_tasks.get(str(hist_id))
+    if task is not None:
+        try:
+            follow_up = await asyncio.wait_for(asyncio.shield(task), follow_up_wait)
+            return {"follow_up_status": "ready", "follow_up_questions": follow_up}
+        except asyncio.TimeoutError:
+            return {"follow_up_status": "pending", "follow_up_questions": []}
+
+    turn = await run_db(get_selected_history, hist_id, native=True)
+    if not turn:
+        return None
+    if turn["followup"] is None:
+        # generated by another worker
+        return {"follow_up_status": "pending", "follow_up_questions": []}
+    return {
+        "follow_up_status": "ready",
+        "follow_up_questions": [question for question in turn["followup"].split("\n") if question],
+    }
+
+
+async def stream_response_over_doc(prompt, conv_id, doc_id, user_id, memory):
+    """
+    Stream the answer over the document token by token
+    :param prompt:
+    :param conv_id:
+    :param doc_id:
+    :param user_id:
+    :param memory:
+    :return: async generator of events, the last one is the same result as get_response_over_doc
+    """
+    if doc_id is None:
+        await run_db(save_error, "No document selected")
+        yield end_event({
             "status": "error",
             "message": "No document selected",
             "conversation_id": None
-        }
+        })
+        return
+
+    context = await load_turn_context(conv_id, doc_id, memory)
+    if context is None:
+        yield end_event(conversation_not_found(conv_id))
+        return
+
+    lookup = await find_cached_answer(prompt, doc_id)
+    if lookup["cached"] is not None:
+        cached = lookup["cached"]
+        yield token_event(cached["answer"])
+        yield end_event(await save_doc_turn(prompt, conv_id, cached["answer"], cached["source"],
+                                            cached["follow_up"], True))
+        return
+
+    handler = AsyncIteratorCallbackHandler()
+    cur_conversation = await get_doc_chain(doc_id, context["history"], context["summary"],
+                                           get_turn_llm(context, streaming=True, callbacks=[handler]))
+    fallback_chain = await get_doc_chain(doc_id, context["history"], context["summary"], get_turn_llm(context))
+
+    deadline = asyncio.get_running_loop().time() + latency_budget
+    task = asyncio.create_task(asyncio.wait_for(cur_conversation.acall({"query": prompt}), latency_budget))
+    task.add_done_callback(lambda _: handler.done.set())
+    fallback_task = start_fallback(prompt, context, fallback_chain)
+    try:
+        # hold the tokens back while the answer can still be "NONE"
+        buffer = ""
+        streaming = False
+        async for token in answer_tokens(handler.aiter()):
+            if streaming:
+                yield token_event(token)
+                continue
+            buffer += token
+            if not "NONE".startswith(buffer.strip()):
+                streaming = True
+                yield token_event(buffer)
+                # the document has an answer, the speculative fallback lost
+                if fallback_task is not None:
+                    fallback_task.cancel()
+
+        result = await task
+        response = format_response(result['result'], single_call_follow_up)
+
+        if response["answer"] == "NONE":
+            remaining = max(deadline - asyncio.get_running_loop().time(), 0)
+            result, response = await asyncio.wait_for(await_fallback(fallback_task, prompt, context, fallback_chain),
+                                                      remaining)
+            yield token_event(response["answer"])
+        elif not streaming:
+            yield token_event(buffer)
+
+        # the follow up questions come with the end event
+        final = await finish_doc_response(prompt, conv_id, doc_id, context, response["answer"],
+                                          result["source_documents"], lookup, response["follow_up_questions"],
+                                          wait_follow_up=True)
+    except asyncio.TimeoutError:
+        await run_db(save_error, "No response over the document within the latency budget")
+        yield end_event(timeout_result(conv_id))
+        return
+    except Exception as e:
+        await run_db(save_error, e)
+        yield end_event({
+            "status": "error",
+            "message": "Error while getting response",
+            "conversation_id": str(conv_id),
+            "data": {
+                "response": str(e),
+            }
+        })
+        return
+    finally:
+        task.cancel()
+        if fallback_task is not None:
+            fallback_task.cancel()
 
+    yield end_event(final)
 
-def get_follow_up_questions_doc(doc_id, history):
 
-    if doc_id is not None:
-        doc = get_doc_by_id(doc_id)
-
-        hist = ""
-        if history is None:
-            history = []
-        history = history[-3:]
-        for h in history:
-            hist += "question: " + h["prompt"] + "\n"
-            hist += "answer: " + h["answer"] + "\n"
-
-        tmp = "Suggest 3 follow up questions based on the  document summary, document name " \
-            "and history of the conversation." \
-            "Give more attention to the last question and answer in the history." \
-            "Answer only the follow up questions. Don't try to make up an answer. Separate them with new line" \
-            "<document summary>" + doc['summary'] + "</document summary>" \
-            "<document name>" + doc['name'] + "</document name>" \
-            "<history>" + hist + "</history>," \
-            "Follow up questions: "
-
-        system = PromptTemplate(
-            template="",
-            input_variables=[],
-        )
-        system_message_prompt = SystemMessagePromptTemplate(prompt=system)
-        human_template = "{text}"
-        human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+async def answer_tokens(tokens):
+    """
+    Drop the follow up questions written after the answer from the streamed tokens
+    :param tokens: async iterator of tokens
+    :return: async generator of the parts of the answer
+    """
+    answer_stream = AnswerStream(single_call_follow_up)
+    async for token in tokens:
+        part = answer_stream.feed(token)
+        if part:
+            yield part
+    part = answer_stream.flush()
+    if part:
+        yield part
 
-        chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt, human_message_prompt])
-        chain = LLMChain(llm=llm, prompt=chat_prompt)
 
-        try:
-            response = chain.run(text=tmp)
-            response = response.replace("Follow up questions: ", "")
-            response = response.split("\n")
-            return response
+def token_event(token):
+    """
+    Stream event with the next part of the answer
+    :param token:
+    :return:
+    """
+    return {"event": "token", "data": {"token": token}}
 
-        except Exception as e:
-            save_error(e)
-            return []
 
+def end_event(result):
+    """
+    Last stream event with the full result
+    :param result:
+    :return:
+    """
+    return {"event": "end", "data": result}
 
-def get_prompt_suggestion_doc(prompt, doc_id, history):
-    # TODO: Rewrite the prompt with the API (give summary of the document and the name of the document)
-    doc = get_doc_by_id(doc_id)
-    title = doc["name"]
-    summary = doc["summary"]
 
+def format_history(history):
+    """
+    Format the turns for the prompts
+    :param history:
+    :return:
+    """
     hist = ""
-    if history is None:
-        history = []
-    for h in history:
+    for h in history or []:
         hist += "question: " + h["prompt"] + "\n"
         hist += "answer: " + h["answer"] + "\n"
+    return hist
+
+
+async def get_follow_up_questions_doc(doc, history, user_id=None):
+    """
+    Suggest follow up questions
+    :param doc: name and summary of the document
+    :param history:
+    :param user_id:
+    :return:
+    """
+    hist = format_history((history or [])[-3:])
+
+    tmp = "Suggest 3 follow up questions based on the  document summary, document name " \
+        "and history of the conversation." \
+        "Give more attention to the last question and answer in the history." \
+        "Answer only the follow up questions. Don't try to make up an answer. Separate them with new line" \
+        "<document summary>" + doc['summary'] + "</document summary>" \
+        "<document name>" + doc['name'] + "</document name>" \
+        "<history>" + hist + "</history>," \
+        "Follow up questions: "
+
+    system = PromptTemplate(
+        template="",
+        input_variables=[],
+    )
+    system_message_prompt = SystemMessagePromptTemplate(prompt=system)
+    human_template = "{text}"
+    human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
+
+    chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt, human_message_prompt])
+    chain = LLMChain(llm=get_llm(model_name[0], user_id=user_id, site="follow_up"), prompt=chat_prompt)
+
+    try:
+        response = await chain.arun(text=tmp)
+        response = response.replace("Follow up questions: ", "")
+        response = response.split("\n")
+        return response
+
+    except Exception as e:
+        await run_db(save_error, e)
+        return []
+
+
+async def get_prompt_suggestion_doc(prompt, doc, history, user_id=None):
+    """
+    Rewrite the prompt with the summary and the name of the document
+    :param prompt:
+    :param doc: name and summary of the document
+    :param history:
+    :param user_id:
+    :return:
+    """
+    title = doc["name"]
+    summary = doc["summary"]
+    hist = format_history(history)
 
     tmp = "Give a revised and optimized prompt based on the original prompt, document summary, document " \
           "name and history of the conversation." \
@@ -373,15 +934,15 @@ def get_prompt_suggestion_doc(prompt, doc_id, history):
     human_message_prompt = HumanMessagePromptTemplate.from_template(human_template)
 
     chat_prompt = ChatPromptTemplate.from_messages([system_message_prompt, human_message_prompt])
-    chain = LLMChain(llm=llm, prompt=chat_prompt)
+    chain = LLMChain(llm=get_llm(model_name[0], user_id=user_id, site="prompt_suggestion"), prompt=chat_prompt)
 
     try:
-        response = chain.run(text=tmp)
+        response = await chain.arun(text=tmp)
         response = response.replace("Optimized prompt: ", "")
         return response
 
     except Exception as e:
-        save_error(e)
+        await run_db(save_error, e)
         return prompt
 
 
@@ -1,6 +1,7 @@
 import os
+import re
+
 import openai
-import tiktoken
 from dotenv import load_dotenv
 
 from cocroach_utils.database_utils import save_error
@@ -8,6 +9,17 @@ from cocroach_utils.db_conv import get_conv_by_id
 
 load_dotenv()
 
+# "FOLLOW UP QUESTIONS:", "Follow-up questions:", "**Followup questions:**", ... in any case, at the start of a line
+# or in the middle of one, "questions" is required so an answer line like "Follow up: ..." is not taken for it
+follow_up_marker = re.compile(r"\n?[ \t]*[*#>]*[ \t]*follow[ \t-]?up[ \t]+questions[ \t]*\**[ \t]*:[ \t]*\**",
+                              re.IGNORECASE)
+marker_words = ("follow up questions", "follow-up questions", "followup questions")
+max_marker_length = 32
+answer_prefix = re.compile(r"^\s*\**answer\s*:\s*\**", re.IGNORECASE)
+answer_word = "answer"
+# "- ", "* ", "1. ", "2) "
+question_prefix = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s*")
+
 
 def get_conv_id(conv_id, user_id, doc_id):
     """
@@ -29,80 +41,146 @@ def get_conv_id(conv_id, user_id, doc_id):
     return cur_conv
 
 
-def num_tokens_from_message(message, model="gpt-3.5-turbo"):
-
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-
-    if model == "gpt-3.5-turbo":
-        print("Warning: gpt-3.5-turbo may change over time. Returning num tokens assuming gpt-3.5-turbo-0301.")
-        return num_tokens_from_message(message, model="gpt-3.5-turbo-0301")
-    elif model == "gpt-4":
-        print("Warning: gpt-4 may change over time. Returning num tokens assuming gpt-4-0314.")
-        return num_tokens_from_message(message, model="gpt-4-0314")
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif model == "gpt-4-0314":
-        tokens_per_message = 3
-        tokens_per_name = 1
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.""")
-    num_tokens = len(encoding.encode(message))
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+def format_response(response_input, split_follow_up=True):
+    """
+    Split the answer and the follow up questions that the model wrote after it
+    :param response_input:
+    :param split_follow_up: the model was asked for the follow up questions, otherwise the text is all answer
+    :return: dict with answer and follow_up_questions
+    """
+    answer = answer_prefix.sub("", response_input).strip()
+    # most answers have no marker, the plain substring test is much faster than the regex
+    has_marker = split_follow_up and ("ollow" in response_input or "OLLOW" in response_input)
+    match = follow_up_marker.search(response_input) if has_marker else None
+    if match is not None:
+        before = answer_prefix.sub("", response_input[:match.start()]).strip()
+        # a marker before any answer is not a split, the full text is the answer
+        if before:
+            return {
+                "answer": before,
+                "follow_up_questions": parse_follow_up_questions(response_input[match.end():]),
+            }
+    return {
+        "answer": answer,
+        "follow_up_questions": [],
+    }
 
 
-def format_response(response_input):
+def parse_follow_up_questions(text):
     """
-    Format the response
-    :param response_input:
+    Get the questions from the lines after the follow up marker, without their bullets or numbers
+    :param text:
+    :return: list of questions
+    """
+    questions = [question_prefix.sub("", line).strip() for line in text.strip().split("\n")]
+    questions = [question for question in questions if question]
+    if len(questions) == 1 and questions[0].count("?") > 1:
+        # all the questions on one line
+        questions = [question.strip() + "?" for question in questions[0].split("?") if question.strip()]
+    return questions
+
+
+def could_be_marker(text):
+    """
+    Check if the end of the text may still become the follow up marker
+    :param text: text from a possible start of the marker
     :return:
     """
-    data = []
-    # check if there are follow up questions regardless of uppercase or lowercase
-    if "FOLLOW UP QUESTIONS:" in response_input:
-        data = response_input.split("FOLLOW UP QUESTIONS:")
-    elif "FOLLOWUP QUESTIONS:" in response_input:
-        data = response_input.split("FOLLOWUP QUESTIONS:")
-    elif "Follow up questions:" in response_input:
-        data = response_input.split("Follow up questions:")
-    elif "Followup questions:" in response_input:
-        data = response_input.split("Followup questions:")
-    elif "follow up questions:" in response_input:
-        data = response_input.split("follow up questions:")
-    elif "followup questions:" in response_input:
-        data = response_input.split("followup questions:")
-    elif "Followup" in response_input:
-        data = response_input.split("Followup:")
-    elif "FOLLOWUP" in response_input:
-        data = response_input.split("FOLLOWUP:")
-    elif "followup" in response_input:
-        data = response_input.split("followup:")
-    elif "follow-up" in response_input:
-        data = response_input.split("follow-up:")
-
-    if len(data) > 1:
-        # answer = data[0].strip().replace("ANSWER:", "")
-        # answer = data[0].strip().replace("answer:", "")
-        answer = data[0].strip().replace("Answer:", "")
-        follow_up_questions = data[1].strip().split("\n")
-        if len(follow_up_questions) == 1:
-            follow_up_questions = data[1].strip().split("?")
-        return {
-            "answer": answer,
-            "follow_up_questions": follow_up_questions
-        }
+    text = text.lstrip(" \t\n*#>").lower()
+    return any(text.startswith(word) or word.startswith(text) for word in marker_words)
+
+
+def find_answer_start(text):
+    """
+    Get where the answer starts after the "Answer:" prefix and the blanks
+    :param text: start of the streamed text
+    :return: position, or None while the prefix may still be coming
+    """
+    match = answer_prefix.match(text)
+    if match is None:
+        head = text.lstrip().lstrip("*").lower()
+        if answer_word.startswith(head) or (head.startswith(answer_word) and not head[len(answer_word):].strip()):
+            return None
+        start = 0
     else:
-        return {
-            "answer": response_input.replace("ANSWER:", "").strip(),
-            "follow_up_questions": [],
-            "source": ""
-        }
+        start = match.end()
+    rest = text[start:].lstrip()
+    return len(text) - len(rest) if rest else None
+
+
+class AnswerStream:
+    """
+    Release the streamed tokens of the answer and hold back the follow up questions written after it,
+    the released parts add up to the answer of format_response
+    """
+
+    def __init__(self, split_follow_up=True):
+        self.text = ""
+        self.start = None
+        self.sent = 0
+        self.done = False
+        self.split_follow_up = split_follow_up
+
+    def feed(self, token):
+        """
+        Add the next token
+        :param token:
+        :return: text of the answer that can be sent
+        """
+        if self.done:
+            return ""
+        self.text += token
+        if self.start is None:
+            self.start = find_answer_start(self.text)
+            if self.start is None:
+                return ""
+            self.sent = self.start
+        if not self.split_follow_up:
+            return self.release(len(self.text))
+        # the end of the text that may become the marker is held back, so the marker starts after the sent text
+        match = follow_up_marker.search(self.text, max(self.sent - max_marker_length, self.start))
+        if match is None:
+            return self.release(self.hold_start())
+        if not self.text[self.start:match.start()].strip():
+            # a marker before any answer is not a split, the full text is the answer
+            self.split_follow_up = False
+            return self.release(len(self.text))
+        self.done = True
+        return self.release(match.start())
+
+    def flush(self):
+        """
+        End of the stream
+        :return: text of the answer held back
+        """
+        if self.done:
+            return ""
+        if self.start is None:
+            # only blanks or the prefix, format_response gives the same
+            self.start = self.sent = len(self.text)
+            return answer_prefix.sub("", self.text).strip()
+        return self.release(len(self.text))
+
+    def hold_start(self):
+        """
+        Get where the end of the text that may still become the follow up marker starts
+        :return:
+        """
+        for position in range(max(len(self.text) - max_marker_length, self.sent), len(self.text)):
+            if could_be_marker(self.text[position:]):
+                return position
+        return len(self.text)
+
+    def release(self, end):
+        """
+        Get the text up to end that was not sent yet, the trailing blanks wait for the text after them
+        :param end:
+        :return:
+        """
+        end = max(len(self.text[:end].rstrip()), self.sent)
+        part = self.text[self.sent:end]
+        self.sent = end
+        return part
 
 
 def moderation(text):
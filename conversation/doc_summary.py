@@ -0,0 +1,84 @@
+# Map-reduce summary of the documents: the chunks are summarized in parallel, every summary is cached on disk
+# by the chat model, and the summaries are combined in several levels so the prompt stays in the context window
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+from langchain import LLMChain, PromptTemplate
+
+from utils.tokens import count_tokens_batch
+
+load_dotenv()
+# llm calls in flight for one document
+map_concurrency = int(os.getenv("SUMMARY_MAP_CONCURRENCY", 8))
+# tokens of summaries combined in one reduce call
+reduce_tokens = int(os.getenv("SUMMARY_REDUCE_TOKENS", 3000))
+
+prompt_template = """Write a concise and condensed summary of the following:
+
+    {text}
+
+    CONCISE SUMMARY:"""
+
+
+def summarize_text(llm, text):
+    """
+    Summarize one text, the result is cached by the llm cache
+    :param llm:
+    :param text:
+    :return:
+    """
+    chain = LLMChain(llm=llm, prompt=PromptTemplate(template=prompt_template, input_variables=["text"]))
+    return chain.run(text=text)
+
+
+def summarize_texts(llm, texts):
+    """
+    Summarize the texts in parallel
+    :param llm:
+    :param texts:
+    :return: summaries in the order of the texts
+    """
+    if len(texts) == 1:
+        return [summarize_text(llm, texts[0])]
+    with ThreadPoolExecutor(max_workers=map_concurrency, thread_name_prefix="summary") as executor:
+        return list(executor.map(lambda text: summarize_text(llm, text), texts))
+
+
+def group_summaries(summaries, max_tokens):
+    """
+    Group consecutive summaries so every group fits in one reduce prompt, a group has at least two summaries
+    so every level at least halves their number even when they do not shrink
+    :param summaries:
+    :param max_tokens:
+    :return: list of texts to summarize
+    """
+    groups = []
+    group = []
+    tokens = 0
+    for summary, count in zip(summaries, count_tokens_batch(summaries)):
+        if len(group) > 1 and tokens + count > max_tokens:
+            groups.append("\n".join(group))
+            group = []
+            tokens = 0
+        group.append(summary)
+        tokens += count
+    if group:
+        groups.append("\n".join(group))
+    return groups
+
+
+def reduce_summaries(llm, summaries):
+    """
+    Combine the summaries level by level until one summary is left
+    :param llm:
+    :param summaries:
+    :return:
+    """
+    if not summaries:
+        return ""
+    while True:
+        groups = group_summaries(summaries, reduce_tokens)
+        summaries = summarize_texts(llm, groups)
+        if len(summaries) == 1:
+            return summaries[0]
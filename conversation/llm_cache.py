@@ -0,0 +1,175 @@
+# Exact-match cache of the chat model calls on local disk. The calls run at temperature 0, so the same model and
+# rendered prompt give the same answer: the answer is kept by the hash of both and a repeated call is read from disk.
+# The counters are kept by call site (answer, follow_up, prompt_suggestion, doc_summary, ...).
+import asyncio
+import hashlib
+import os
+import threading
+
+import orjson
+from dotenv import load_dotenv
+from langchain.chat_models import ChatOpenAI
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
+
+from utils.async_utils import run_blocking
+from utils.disk_cache import DiskCache
+from utils.metering import UsageCallbackHandler
+
+load_dotenv()
+cache_enabled = os.getenv("LLM_CACHE_ENABLED", "true") == "true"
+cache_path = os.getenv("LLM_CACHE_PATH", "./cache/llm.sqlite")
+cache_max_entries = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 100000))
+
+llm_cache = None
+cache_lock = threading.Lock()
+stats_lock = threading.Lock()
+stats = {}
+
+
+def get_llm_cache():
+    """
+    Get the disk cache of the answers, opened once for the process
+    :return:
+    """
+    global llm_cache
+    if llm_cache is None:
+        with cache_lock:
+            if llm_cache is None:
+                llm_cache = DiskCache(cache_path, cache_max_entries)
+    return llm_cache
+
+
+def count_lookup(site, hit):
+    """
+    Update the counters of the call site
+    :param site:
+    :param hit:
+    :return:
+    """
+    with stats_lock:
+        counters = stats.setdefault(site, {"hits": 0, "misses": 0})
+        counters["hits" if hit else "misses"] += 1
+
+
+def get_llm_cache_stats():
+    """
+    Get the counters by call site
+    :return:
+    """
+    with stats_lock:
+        sites = {site: dict(counters) for site, counters in stats.items()}
+    for counters in sites.values():
+        requests = counters["hits"] + counters["misses"]
+        counters["hit_rate"] = counters["hits"] / requests if requests else 0.0
+    return {
+        "enabled": cache_enabled,
+        "sites": sites,
+    }
+
+
+def encode_result(result):
+    """
+    Serialize the answers of a call, only plain assistant messages are cached
+    :param result: ChatResult
+    :return: bytes or None
+    """
+    contents = []
+    for generation in result.generations:
+        message = generation.message
+        if not isinstance(message, AIMessage) or message.additional_kwargs:
+            return None
+        contents.append(message.content)
+    return orjson.dumps(contents)
+
+
+def decode_result(data, model_name):
+    """
+    Rebuild the result of a call from the cache, with no token usage
+    :param data:
+    :param model_name:
+    :return: ChatResult
+    """
+    generations = [ChatGeneration(message=AIMessage(content=content)) for content in orjson.loads(data)]
+    llm_output = {
+        "token_usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        "model_name": model_name,
+        "cached": True,
+    }
+    return ChatResult(generations=generations, llm_output=llm_output)
+
+
+class CachedChatOpenAI(ChatOpenAI):
+    """
+    Chat model that reads the answers of the deterministic calls from the disk cache
+    """
+
+    cache_site: str = "default"
+    """Name of the call site in the counters"""
+    cache_bypass: bool = False
+    """Always call the API, the answer is not stored either"""
+
+    def get_cache_key(self, messages, stop, kwargs):
+        """
+        Get the cache key of the call: model, parameters and rendered messages
+        :param messages:
+        :param stop:
+        :param kwargs: extra parameters of the call
+        :return: key or None if the call is not cacheable
+        """
+        if not cache_enabled or self.cache_bypass or self.temperature != 0:
+            return None
+        message_dicts, params = self._create_message_dicts(messages, stop)
+        source = orjson.dumps({
+            "model": self.model_name,
+            "n": self.n,
+            "max_tokens": self.max_tokens,
+            "stop": params.get("stop"),
+            "model_kwargs": self.model_kwargs,
+            "kwargs": kwargs,
+            "messages": message_dicts,
+        }, option=orjson.OPT_SORT_KEYS, default=str)
+        return self.model_name + ":" + hashlib.sha256(source).hexdigest()
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self.get_cache_key(messages, stop, kwargs)
+        if key is not None:
+            data = get_llm_cache().get(key)
+            count_lookup(self.cache_site, data is not None)
+            if data is not None:
+                result = decode_result(data, self.model_name)
+                if self.streaming and run_manager:
+                    for generation in result.generations:
+                        run_manager.on_llm_new_token(generation.text)
+                return result
+
+        result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        data = encode_result(result) if key is not None else None
+        if data is not None:
+            get_llm_cache().set(key, data)
+        return result
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self.get_cache_key(messages, stop, kwargs)
+        if key is not None:
+            data = await run_blocking(get_llm_cache().get, key)
+            count_lookup(self.cache_site, data is not None)
+            if data is not None:
+                result = decode_result(data, self.model_name)
+                if self.streaming and run_manager:
+                    for generation in result.generations:
+                        await run_manager.on_llm_new_token(generation.text)
+                return result
+
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except asyncio.CancelledError:
+            # the speculative calls that lost, langchain sends no callback for them
+            if run_manager:
+                for handler in run_manager.handlers:
+                    if isinstance(handler, UsageCallbackHandler):
+                        handler.on_llm_cancel(run_manager.run_id)
+            raise
+        data = encode_result(result) if key is not None else None
+        if data is not None:
+            await run_blocking(get_llm_cache().set, key, data)
+        return result
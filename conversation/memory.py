@@ -0,0 +1,156 @@
+# Memory of the conversations: the prompt gets the most recent turns that fit in the token budget of the model,
+# the older turns are compacted into a rolling summary saved in conversations.summary.
+# The summary is updated in the background after the answer, so it never delays a response.
+import asyncio
+import os
+
+from dotenv import load_dotenv
+from langchain import LLMChain
+from langchain.memory.prompt import SUMMARY_PROMPT
+
+from cocroach_utils.database_utils import run_db, save_error
+from cocroach_utils.db_conv import update_conversation_summary
+from cocroach_utils.db_history import get_history_since
+from utils.tokens import count_tokens_batch
+
+load_dotenv()
+# tokens of history in the prompt, by model
+token_budgets = {
+    "gpt-3.5-turbo": 1024,
+    "gpt-3.5-turbo-16k": 4096,
+    "gpt-4": 2048,
+    "gpt-4-32k": 8192,
+}
+default_token_budget = int(os.getenv("MEMORY_TOKEN_BUDGET", 1024))
+# tokens of turns summarized in one call
+summary_batch_tokens = int(os.getenv("MEMORY_SUMMARY_BATCH_TOKENS", 2000))
+
+# conversations whose summary is being updated
+running = set()
+background_tasks = set()
+
+
+def get_token_budget(model):
+    """
+    Get the tokens of history allowed in the prompt of the model
+    :param model:
+    :return:
+    """
+    return token_budgets.get(model, default_token_budget)
+
+
+def count_turn_tokens(model, turns):
+    """
+    Count the tokens of every turn
+    :param model:
+    :param turns:
+    :return: list of token counts, in the order of the turns
+    """
+    texts = [turn["prompt"] + "\n" + turn["answer"] for turn in turns]
+    return count_tokens_batch(texts, model)
+
+
+def select_turns(history, model, memory):
+    """
+    Keep the most recent turns that fit in the token budget of the model
+    :param history: turns from oldest to newest
+    :param model:
+    :param memory: maximum number of turns, 0 or -1 for none
+    :return: kept turns from oldest to newest
+    """
+    if memory <= 0 or not history:
+        return []
+    history = history[-memory:]
+    budget = get_token_budget(model)
+    kept = 0
+    for tokens in reversed(count_turn_tokens(model, history)):
+        if tokens > budget:
+            break
+        budget -= tokens
+        kept += 1
+    return history[len(history) - kept:]
+
+
+def format_summary(summary):
+    """
+    Format the rolling summary for the prompts
+    :param summary:
+    :return:
+    """
+    if not summary:
+        return ""
+    return "Summary of the earlier conversation: " + summary
+
+
+def group_turns(model, turns):
+    """
+    Group consecutive turns so every group fits in one summary call
+    :param model:
+    :param turns:
+    :return: list of lists of turns
+    """
+    groups = []
+    group = []
+    tokens = 0
+    for turn, turn_tokens in zip(turns, count_turn_tokens(model, turns)):
+        if group and tokens + turn_tokens > summary_batch_tokens:
+            groups.append(group)
+            group = []
+            tokens = 0
+        group.append(turn)
+        tokens += turn_tokens
+    if group:
+        groups.append(group)
+    return groups
+
+
+async def update_summary(llm, conv_id, summary, summary_until, keep):
+    """
+    Add the turns older than the kept ones, and not summarized yet, to the rolling summary
+    :param llm:
+    :param conv_id:
+    :param summary: current summary
+    :param summary_until: time of the last summarized turn, None if nothing was summarized
+    :param keep: number of recent turns left out of the summary
+    :return:
+    """
+    turns = await run_db(get_history_since, conv_id, summary_until)
+    turns = turns[:len(turns) - keep] if keep else turns
+    if not turns:
+        return
+
+    chain = LLMChain(llm=llm, prompt=SUMMARY_PROMPT)
+    summary = summary or ""
+    for group in group_turns(llm.model_name, turns):
+        new_lines = "\n".join("Human: " + turn["prompt"] + "\nAI: " + turn["answer"] for turn in group)
+        summary = await chain.apredict(summary=summary, new_lines=new_lines)
+        # saved after every group so an interrupted update continues from there
+        await run_db(update_conversation_summary, conv_id, summary, group[-1]["time"])
+
+
+def schedule_summary_update(llm, conv_id, summary, summary_until, keep):
+    """
+    Update the rolling summary in the background, at most one update runs for a conversation
+    :param llm:
+    :param conv_id:
+    :param summary:
+    :param summary_until:
+    :param keep:
+    :return:
+    """
+    if conv_id in running:
+        return
+    running.add(conv_id)
+
+    async def run():
+        try:
+            await update_summary(llm, conv_id, summary, summary_until, keep)
+        except Exception as e:
+            await run_db(save_error, e)
+        finally:
+            running.discard(conv_id)
+
+    task = asyncio.create_task(run())
+    # keep a reference until the task is done
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
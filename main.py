@@ -1,27 +1,47 @@
 import hashlib
+import os
 from dotenv import load_dotenv
 
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
+from cocroach_utils.catalog_cache import get_catalog_cache_stats
+from cocroach_utils.conv_cache import get_conv_cache_stats
+from cocroach_utils.database_utils import run_db, get_pool_metrics
 from cocroach_utils.db_assistants import get_all_assistants, get_assistant_by_id, update_assistant, add_assistant, \
     delete_assistant, update_assistant_field
 from cocroach_utils.db_models import get_all_models, get_model_by_id, update_model, add_model, delete_model
 from cocroach_utils.db_users import add_user, get_user_by_email, get_user_by_id, update_user, \
-    update_user_field
-from cocroach_utils.db_history import get_history_for_conv, update_history_field_by_id, delete_history_by_id
-from cocroach_utils.db_conv import get_user_conversations, get_conv_by_id, \
+    update_user_field, get_user_tokens
+from cocroach_utils.db_history import get_history_page, update_history_field_by_id, delete_history_by_id
+from cocroach_utils.db_conv import get_user_conversations_page, get_conv_by_id, \
     delete_conversation, \
     add_conversation, update_conversation_field
-from cocroach_utils.db_docs import get_user_docs, get_all_docs, delete_doc_by_id, get_doc_by_id, update_doc_field_by_id
-from models import ConvRequest, User, Conversation, History, Document, Model, Assistant
-from utils.return_api import check_api_key, wrong_api, check_result, return_error, return_success
-from vectordb.vectordb import create_vector_index
-from conversation.conv import get_response_over_doc, get_simple_response, get_doc_summary
+from cocroach_utils.db_docs import get_docs_page, delete_doc_by_id, get_doc_by_id, update_doc_field_by_id
+from cocroach_utils.db_jobs import get_job_by_id
+from cocroach_utils.db_usage import get_user_usage
+from cocroach_utils.migrations import run_migrations, get_pending_versions
+from models import ConvRequest, User, Conversation, History, Document, Model, Assistant, EmptyRequest, Job
+from utils.return_api import check_api_key, wrong_api, check_result, return_error, return_success, stream_events, \
+    FastJSONResponse
+from vectordb.embedding_cache import get_embedding_cache_stats
+from vectordb.answer_cache import get_answer_cache_stats
+from vectordb.store_cache import get_vector_store_stats
+from vectordb.ingest_jobs import enqueue_job, start_scheduler
+from vectordb.vectordb import save_upload
+from conversation.llm_cache import get_llm_cache_stats
+from conversation.conv import get_response_over_doc, get_simple_response, stream_simple_response, \
+    stream_response_over_doc, get_follow_up_by_history
+from utils.async_utils import run_blocking, request_slot
+from utils.metering import start_flusher, flush_usage, get_metering_stats
+from utils.tokens import preload_encoders
 
 load_dotenv()
-app = FastAPI()
+app = FastAPI(default_response_class=FastJSONResponse)
 debug = True
+# apply the pending schema migrations when the server starts, the server does not start with pending migrations
+migrate_on_startup = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() == "true"
 
 origins = [
     "http://localhost.com",
@@ -48,6 +68,28 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup():
+    if migrate_on_startup:
+        await run_blocking(run_migrations)
+    else:
+        pending = await run_blocking(get_pending_versions)
+        if pending:
+            raise RuntimeError(f"Pending database migrations {pending}, run python -m cocroach_utils.migrations")
+    # load the token encoders of the models now instead of in the first request
+    models = await run_db(get_all_models)
+    await run_blocking(preload_encoders, [model['name'] for model in models or []])
+    start_flusher()
+    # continue the ingestion jobs interrupted by a stopped worker, now and periodically
+    start_scheduler()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # write the usage not flushed yet
+    await run_blocking(flush_usage)
+
+
 @app.get("/")
 def read_root():
     return {"Page not found"}
@@ -63,7 +105,8 @@ async def api_get_simple_response(body: ConvRequest):
     if check_api_key(body.api_key) is False:
         return wrong_api()
     try:
-        result = get_simple_response(body.user_message, body.conversation_id, body.user_id, body.memory)
+        async with request_slot():
+            result = await get_simple_response(body.user_message, body.conversation_id, body.user_id, body.memory)
         return check_result(result, 400, "No response")
     except Exception as e:
         return return_error(400, str(e))
@@ -74,12 +117,40 @@ async def api_get_doc_response(body: ConvRequest):
     if check_api_key(body.api_key) is False:
         return wrong_api()
     try:
-        result = get_response_over_doc(body.user_message, body.conversation_id, body.document, body.user_id, body.memory)
+        async with request_slot():
+            result = await get_response_over_doc(body.user_message, body.conversation_id, body.document, body.user_id,
+                                                 body.memory)
         return check_result(result, 400, "No response")
     except Exception as e:
         return return_error(400, str(e))
 
 
+@app.post("/response/simple/stream")
+async def api_stream_simple_response(body: ConvRequest):
+    """
+    Stream the answer as Server-Sent Events: "token" events and a final "end" event with the result
+    :param body:
+    :return:
+    """
+    if check_api_key(body.api_key) is False:
+        return wrong_api()
+    events = stream_simple_response(body.user_message, body.conversation_id, body.user_id, body.memory)
+    return StreamingResponse(stream_events(events), media_type="text/event-stream")
+
+
+@app.post("/response/doc/stream")
+async def api_stream_doc_response(body: ConvRequest):
+    """
+    Stream the answer over the document as Server-Sent Events, follow ups and sources come with the "end" event
+    :param body:
+    :return:
+    """
+    if check_api_key(body.api_key) is False:
+        return wrong_api()
+    events = stream_response_over_doc(body.user_message, body.conversation_id, body.document, body.user_id,
+                                      body.memory)
+    return StreamingResponse(stream_events(events), media_type="text/event-stream")
+
 
 # CONVERSATIONS ENDPOINTS
 @app.post("/conv/get")
@@ -88,12 +159,17 @@ async def api_get_conversation(body: Conversation):
         return wrong_api()
     try:
         if body.conv_id is not None:
-            result = get_conv_by_id(body.conv_id)
+            result = await run_db(get_conv_by_id, body.conv_id, True)
         elif body.user_id is not None:
-            result = get_user_conversations(body.user_id)
+            # one page, the next one is requested with its next_page_token
+            result = await run_db(get_user_conversations_page, body.user_id, body.limit, body.page_token,
+                                  body.columns)
+            if not result["rows"]:
+                result = None
         else:
             return return_error(400, "conv_id or user_id is required")
-        return check_result(result, 400, "Conversation do not exist")
+        # returned as a response so the rows skip the jsonable_encoder pass
+        return FastJSONResponse(check_result(result, 400, "Conversation do not exist"))
     except Exception as e:
         return return_error(400, str(e))
 
@@ -107,7 +183,7 @@ async def api_add_conversation(body: Conversation):
     if body.title is None:
         return return_error(400, "Title is required")
     try:
-        result = add_conversation(body.user_id, body.doc_id, body.title)
+        result = await run_db(add_conversation, body.user_id, body.doc_id, body.title)
         return check_result(result, 400, "Cant create conversation")
     except Exception as e:
         return return_error(400, str(e))
@@ -124,7 +200,7 @@ async def api_update_conv(body: Conversation):
     if body.value is None:
         return return_error(400, "Conversation value is required")
     try:
-        result = update_conversation_field(body.conv_id, body.field, body.value)
+        result = await run_db(update_conversation_field, body.conv_id, body.field, body.value)
         return check_result(result, 400, "Cant update conversation")
     except Exception as e:
         return return_error(400, str(e))
@@ -135,7 +211,7 @@ async def api_delete_conv(body: Conversation):
     if check_api_key(body.api_key) is False:
         return wrong_api()
     try:
-        result = delete_conversation(body.conv_id)
+        result = await run_db(delete_conversation, body.conv_id)
         return check_result(result, 400, "Cant delete conversation")
     except Exception as e:
         return return_error(400, str(e))
@@ -147,8 +223,13 @@ async def api_get_history(body: Conversation):
     if check_api_key(body.api_key) is False:
         return wrong_api()
     try:
-        result = get_history_for_conv(body.conv_id, body.limit)
-        return check_result(result, 400, "No history")
+        # one page, the next one is requested with its next_page_token
+        # compact: one list of columns and the rows as lists of values
+        result = await run_db(get_history_page, body.conv_id, body.limit, body.page_token, body.columns,
+                              body.compact)
+        if not result["rows"]:
+            result = None
+        return FastJSONResponse(check_result(result, 400, "No history"))
     except Exception as e:
         return return_error(400, str(e))
 
@@ -158,12 +239,30 @@ async def api_delete_history(body: History):
     if check_api_key(body.api_key) is False:
         return wrong_api()
     try:
-        result = delete_history_by_id(body.hist_id)
+        result = await run_db(delete_history_by_id, body.hist_id)
         return check_result(result, 400, "Cant delete")
     except Exception as e:
         return return_error(400, str(e))
 
 
+@app.post("/history/follow_up")
+async def api_history_follow_up(body: History):
+    """
+    Get the follow up questions of a turn over a document, /response/doc returns before they are generated
+    :param body:
+    :return:
+    """
+    if check_api_key(body.api_key) is False:
+        return wrong_api()
+    if body.hist_id is None:
+        return return_error(400, "History id is required")
+    try:
+        result = await get_follow_up_by_history(body.hist_id)
+        return check_result(result, 400, "History not found")
+    except Exception as e:
+        return return_error(400, str(e))
+
+
 @app.post("/history/update_field")
 async def api_history_update_field(body: History):
     if check_api_key(body.api_key) is False:
@@ -175,7 +274,7 @@ async def api_history_update_field(body: History):
     if body.value is None:
         return return_error(400, "History value is required")
     try:
-        result = update_history_field_by_id(body.hist_id, body.field, body.value)
+        result = await run_db(update_history_field_by_id, body.hist_id, body.field, body.value)
         return check_result(result, 400, "Cant update history")
     except Exception as e:
         return return_error(400, str(e))
@@ -188,12 +287,13 @@ async def api_get_docs(body: Document):
         return wrong_api()
     try:
         if body.doc_id is not None:
-            result = get_doc_by_id(body.doc_id)
-        elif body.user_id is not None:
-            result = get_user_docs(body.user_id)
+            result = await run_db(get_doc_by_id, body.doc_id, True)
         else:
-            result = get_all_docs()
-        return check_result(result, 400, "No docs")
+            # one page, the next one is requested with its next_page_token
+            result = await run_db(get_docs_page, body.user_id, body.limit, body.page_token, body.columns)
+            if not result["rows"]:
+                result = None
+        return FastJSONResponse(check_result(result, 400, "No docs"))
     except Exception as e:
         return return_error(400, str(e))
 
@@ -201,21 +301,45 @@ async def api_get_docs(body: Document):
 @app.post("/docs/add")
 async def api_upload_file(file: UploadFile = File(...), user_id: int = Form(...), force: bool = Form(...),
                              api_key: str = Form(...)):
+    """
+    Save the file and start the indexing and the summary in the background, the progress is in /docs/status
+    :param file:
+    :param user_id:
+    :param force:
+    :param api_key:
+    :return:
+    """
     if check_api_key(api_key) is False:
         return wrong_api()
 
     try:
-        res = create_vector_index(file, user_id, force)
-        if res['status'] == 'success':
-            summary = get_doc_summary(file, str(res['data']['doc_id']))
-            # TODO: make it as a common format for all return results
-            return {
-                "result": res,
-                "summary": summary,
-                "code": 200,
-            }
-        else:
+        res = await run_blocking(save_upload, file, user_id, force)
+        if res['status'] != 'success' or res['data']['indexed']:
+            # nothing to do for a file that was already ingested
             return return_success(res)
+        job_id = await run_db(enqueue_job, res['data']['doc_id'], user_id, res['data']['filename'])
+        if job_id == -1:
+            return return_error(400, "Cant create ingestion job")
+        # a document uploaded again keeps its job, which may already be running or done
+        job = await run_db(get_job_by_id, job_id)
+        return return_success({
+            "job_id": str(job_id),
+            "doc_id": res['data']['doc_id'],
+            "status": job['status'] if job else "queued",
+        })
+    except Exception as e:
+        return return_error(400, str(e))
+
+
+@app.post("/docs/status")
+async def api_get_doc_status(body: Job):
+    if check_api_key(body.api_key) is False:
+        return wrong_api()
+    if body.job_id is None:
+        return return_error(400, "job_id is required")
+    try:
+        result = await run_db(get_job_by_id, body.job_id)
+        return check_result(result, 400, "Job do not exist")
     except Exception as e:
         return return_error(400, str(e))
 
@@ -231,7 +355,7 @@ async def api_update_doc_field(body: Document):
     if body.value is None:
         return return_error(400, "Doc value is required")
     try:
-        result = update_doc_field_by_id(body.doc_id, body.field, body.value)
+        result = await run_db(update_doc_field_by_id, body.doc_id, body.field, body.value)
         return check_result(result, 400, "Cant update doc")
     except Exception as e:
         return return_error(400, str(e))
@@ -244,7 +368,7 @@ async def api_delete_doc(body: Document):
     if body.doc_id is None:
         return return_error(400, "doc_id is required")
     try:
-        result = delete_doc_by_id(body.doc_id)
+        result = await run_db(delete_doc_by_id, body.doc_id)
         return check_result(result, 400, "Cant delete doc")
     except Exception as e:
         return return_error(400, str(e))
@@ -257,7 +381,7 @@ async def api_login_user(body: User):
     if check_api_key(body.api_key) is False:
         return wrong_api()
     try:
-        user = get_user_by_email(body.email)
+        user = await run_db(get_user_by_email, body.email)
         if len(user) == 0:
             return return_error(400, "User not found")
 
@@ -279,12 +403,29 @@ async def api_get_user(body: User):
     if check_api_key(body.api_key) is False:
         return wrong_api()
     try:
-        user = get_user_by_id(body.user_id)
+        user = await run_db(get_user_by_id, body.user_id)
         return check_result(user, 400, "User not found")
     except Exception as e:
         return return_error(400, str(e))
 
 
+@app.post("/usage/get")
+async def api_get_usage(body: User):
+    if check_api_key(body.api_key) is False:
+        return wrong_api()
+    if body.user_id is None:
+        return return_error(400, "User id is required")
+    try:
+        # the usage of the last calls is written by the flusher every USAGE_FLUSH_INTERVAL seconds
+        tokens_used = await run_db(get_user_tokens, body.user_id)
+        if tokens_used is None:
+            return return_error(400, "User not found")
+        usage = await run_db(get_user_usage, body.user_id)
+        return FastJSONResponse(return_success({"tokens_used": tokens_used, "usage": usage}))
+    except Exception as e:
+        return return_error(400, str(e))
+
+
 @app.post("/user/update")
 async def api_update_user(body: User):
     if check_api_key(body.api_key) is False:
@@ -296,7 +437,7 @@ async def api_update_user(body: User):
     if body.email is None:
         return return_error(400, "User email is required")
     try:
-        result = update_user(body.user_id, body.name, body.email, body.password)
+        result = await run_db(update_user, body.user_id, body.name, body.email, body.password)
         return check_result(result, 400, "Cant update user")
     except Exception as e:
         return return_error(400, str(e))
@@ -315,7 +456,7 @@ async def api_update_user_field(body: User):
 
     if body.field == 'password':
         # if we need to update user password
-        user = get_user_by_id(body.user_id)
+        user = await run_db(get_user_by_id, body.user_id)
         psw = user['password']
         hs_function = hashlib.md5()
         hs_function.update(body.old_password.encode('utf-8'))
@@ -326,13 +467,13 @@ async def api_update_user_field(body: User):
         if psw != old_password:
             return return_error(400, "Wrong password")
         try:
-            result = update_user_field(body.user_id, 'password', new_password)
+            result = await run_db(update_user_field, body.user_id, 'password', new_password)
             return check_result(result, 400, "Cant update user")
         except Exception as e:
             return return_error(400, str(e))
 
     try:
-        result = update_user_field(body.user_id, body.field, body.value)
+        result = await run_db(update_user_field, body.user_id, body.field, body.value)
         return check_result(result, 400, "Cant update user")
     except Exception as e:
         return return_error(400, str(e))
@@ -352,7 +493,7 @@ async def api_add_user(body: User):
     hs_function.update(body.password.encode('utf-8'))
     password = hs_function.hexdigest()
     try:
-        result = add_user(body.name, body.email, password)
+        result = await run_db(add_user, body.name, body.email, password)
         return check_result(result, 400, "Cant create user")
     except Exception as e:
         return return_error(400, str(e))
@@ -365,7 +506,7 @@ async def api_delete_user(body: User):
     if body.user_id is None:
         return return_error(400, "User conv_id is required")
     try:
-        result = update_user_field(body.user_id, 'active', 0)
+        result = await run_db(update_user_field, body.user_id, 'active', 0)
         return check_result(result, 400, "Cant delete user")
     except Exception as e:
         return return_error(400, str(e))
@@ -378,9 +519,9 @@ async def api_get_model(body: Model):
         return wrong_api()
     try:
         if body.model_id is not None:
-            result = get_model_by_id(body.model_id)
+            result = await run_db(get_model_by_id, body.model_id)
         else:
-            result = get_all_models()
+            result = await run_db(get_all_models)
         return check_result(result, 400, "No models")
     except Exception as e:
         return return_error(400, str(e))
@@ -401,7 +542,8 @@ async def api_update_model(body: Model):
     if body.price_out is None:
         return return_error(400, "Model price_out is required")
     try:
-        result = update_model(body.model_id, body.name, body.description, body.price_in, body.price_out)
+        result = await run_db(update_model, body.model_id, body.name, body.description,
+                              body.price_in, body.price_out)
         return check_result(result, 400, "Cant update model")
     except Exception as e:
         return return_error(400, str(e))
@@ -413,7 +555,7 @@ async def api_add_model(body: Model):
     if body.name is None:
         return return_error(400, "Model name is required")
     try:
-        result = add_model(body.name, body.description, body.price_in, body.price_out)
+        result = await run_db(add_model, body.name, body.description, body.price_in, body.price_out)
         return check_result(result, 400, "Cant add model")
     except Exception as e:
         return return_error(400, str(e))
@@ -426,7 +568,7 @@ async def api_delete_model(body: Model):
     if body.model_id is None:
         return return_error(400, "Model conv_id is required")
     try:
-        result = delete_model(body.model_id)
+        result = await run_db(delete_model, body.model_id)
         return check_result(result, 400, "Cant delete model")
     except Exception as e:
         return return_error(400, str(e))
@@ -439,9 +581,9 @@ async def api_get_assistant(body: Assistant):
         return wrong_api()
     try:
         if body.assist_id is not None:
-            result = get_assistant_by_id(body.assist_id)
+            result = await run_db(get_assistant_by_id, body.assist_id)
         else:
-            result = get_all_assistants()
+            result = await run_db(get_all_assistants)
         return check_result(result, 400, "No assistants")
     except Exception as e:
         return return_error(400, str(e))
@@ -456,7 +598,8 @@ async def api_update_assistant(body: Assistant):
     if body.name is None:
         return return_error(400, "Assistant name is required")
     try:
-        result = update_assistant(body.assist_id, body.name, body.description, body.welcome, body.prompt, body.user)
+        result = await run_db(update_assistant, body.assist_id, body.name, body.description, body.welcome,
+                              body.prompt, body.user)
         return check_result(result, 400, "Cant update assistant")
     except Exception as e:
         return return_error(400, str(e))
@@ -473,7 +616,7 @@ async def api_update_assistant_field(body: Assistant):
     if body.value is None:
         return return_error(400, "Assistant value is required")
     try:
-        result = update_assistant_field(body.assist_id, body.field, body.value)
+        result = await run_db(update_assistant_field, body.assist_id, body.field, body.value)
         return check_result(result, 400, "Cant update assistant")
     except Exception as e:
         return return_error(400, str(e))
@@ -486,7 +629,8 @@ async def api_add_assistant(body: Assistant):
     if body.name is None:
         return return_error(400, "Assistant name is required")
     try:
-        result = add_assistant(body.name, body.description, body.welcome, body.prompt, body.user)
+        result = await run_db(add_assistant, body.name, body.description, body.welcome,
+                              body.prompt, body.user)
         return check_result(result, 400, "Cant add assistant")
     except Exception as e:
         return return_error(400, str(e))
@@ -499,7 +643,29 @@ async def api_delete_assistant(body: Assistant):
     if body.assist_id is None:
         return return_error(400, "Assistant conv_id is required")
     try:
-        result = delete_assistant(body.assist_id)
+        result = await run_db(delete_assistant, body.assist_id)
         return check_result(result, 400, "Cant delete assistant")
     except Exception as e:
         return return_error(400, str(e))
+
+
+# STATS ENDPOINTS
+@app.post("/stats/get")
+async def api_get_stats(body: EmptyRequest):
+    """
+    Get the counters of the caches
+    :param body:
+    :return:
+    """
+    if check_api_key(body.api_key) is False:
+        return wrong_api()
+    return return_success({
+        "embedding_cache": get_embedding_cache_stats(),
+        "vector_store_cache": get_vector_store_stats(),
+        "answer_cache": get_answer_cache_stats(),
+        "llm_cache": get_llm_cache_stats(),
+        "db_pool": get_pool_metrics(),
+        "catalog_cache": get_catalog_cache_stats(),
+        "conversation_cache": get_conv_cache_stats(),
+        "metering": get_metering_stats(),
+    })
@@ -38,6 +38,9 @@ class Conversation(BaseModel):
     model: str = None
     assistant: str = None
     limit: int = 10
+    compact: bool = False
+    page_token: str = None
+    columns: list = None
     field: str = None
     value: str = None
 
@@ -49,6 +52,12 @@ class DocRequest(BaseModel):
     force: bool = Form(...)
 
 
+class Job(BaseModel):
+    """Ingestion job model"""
+    api_key: str = None
+    job_id: int = None
+
+
 class EmptyRequest(BaseModel):
     """Empty request model"""
     api_key: str = None
@@ -63,6 +72,9 @@ class Document(BaseModel):
     summary: str = None
     updated: str = None
     active: bool = None
+    limit: int = 10
+    page_token: str = None
+    columns: list = None
     field: str = None
     value: str = None
 
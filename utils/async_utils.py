@@ -0,0 +1,50 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# how many chat requests may run the LLM pipeline at the same time (per worker)
+max_concurrent_requests = int(os.getenv("MAX_CONCURRENT_REQUESTS", 16))
+# threads used for the remaining blocking work (database, disk, document loaders)
+blocking_workers = int(os.getenv("BLOCKING_WORKERS", 32))
+
+executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="blocking")
+request_semaphore = None
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function in the worker thread pool without freezing the event loop
+    :param func:
+    :param args:
+    :param kwargs:
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+def get_request_semaphore():
+    """
+    Get the semaphore that limits concurrent chat requests
+    :return:
+    """
+    global request_semaphore
+    if request_semaphore is None:
+        request_semaphore = asyncio.Semaphore(max_concurrent_requests)
+    return request_semaphore
+
+
+@asynccontextmanager
+async def request_slot():
+    """
+    Wait for a free chat request slot
+    :return:
+    """
+    async with get_request_semaphore():
+        yield
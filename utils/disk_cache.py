@@ -0,0 +1,117 @@
+# Small key-value store on local disk used by the caches of the project
+import os
+import sqlite3
+import threading
+import time
+
+
+class DiskCache:
+    """
+    Thread-safe key-value cache stored in a SQLite file, the least recently written entries are evicted
+    when max_entries is reached
+    """
+
+    evict_ratio = 0.1
+    """Share of max_entries freed by one eviction, so the entries are only counted again after as many writes"""
+
+    def __init__(self, path, max_entries=None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, updated REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_updated ON cache (updated)")
+        self.conn.commit()
+        # upper bound of the entries, every write is counted as new and other processes may write to the file too,
+        # it is only compared to max_entries and recounted before the eviction
+        self.count = self.conn.execute("SELECT count(*) FROM cache").fetchone()[0]
+
+    def get(self, key):
+        """
+        Get one value
+        :param key:
+        :return: value or None
+        """
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, keys):
+        """
+        Get the stored values of the keys
+        :param keys:
+        :return: dict of the found keys
+        """
+        keys = list(set(keys))
+        found = {}
+        with self.lock:
+            # stay below the SQLite limit of variables per statement
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self.conn.execute("SELECT key, value FROM cache WHERE key IN (%s)" % ",".join("?" * len(part)),
+                                         part).fetchall()
+                found.update(rows)
+        return found
+
+    def set(self, key, value):
+        """
+        Store one value
+        :param key:
+        :param value:
+        :return:
+        """
+        self.set_many({key: value})
+
+    def set_many(self, items):
+        """
+        Store the values in one transaction
+        :param items: dict of key and value
+        :return:
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO cache (key, value, updated) VALUES (?, ?, ?)",
+                                  [(key, value, now) for key, value in items.items()])
+            self.count += len(items)
+            self.evict()
+            self.conn.commit()
+
+    def delete(self, key):
+        """
+        Delete one value
+        :param key:
+        :return:
+        """
+        with self.lock:
+            cursor = self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.count = max(self.count - cursor.rowcount, 0)
+            self.conn.commit()
+
+    def evict(self):
+        """
+        Delete the oldest entries once max_entries is reached, down to evict_ratio below it,
+        must be called with the lock held
+        :return:
+        """
+        if self.max_entries is None or self.count <= self.max_entries:
+            return
+        self.count = self.conn.execute("SELECT count(*) FROM cache").fetchone()[0]
+        if self.count > self.max_entries:
+            keep = self.max_entries - int(self.max_entries * self.evict_ratio)
+            self.conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY updated LIMIT ?)",
+                              (self.count - keep,))
+            self.count = keep
+
+    def size(self):
+        """
+        Get the number of entries
+        :return:
+        """
+        with self.lock:
+            self.count = self.conn.execute("SELECT count(*) FROM cache").fetchone()[0]
+            return self.count
@@ -0,0 +1,183 @@
+# Token and cost metering of the LLM and embedding calls. The calls only put their counts in a queue,
+# a background thread aggregates them by user and model and writes the totals to the database periodically,
+# so the metering adds no latency to the requests.
+import os
+import queue
+import threading
+import time
+
+from dotenv import load_dotenv
+from langchain.callbacks.base import BaseCallbackHandler
+
+from cocroach_utils.database_utils import save_error
+from cocroach_utils.db_models import get_all_models
+from cocroach_utils.db_usage import add_usage
+from utils.tokens import count_tokens_batch
+
+load_dotenv()
+# seconds between two writes of the totals
+flush_interval = float(os.getenv("USAGE_FLUSH_INTERVAL", 10))
+
+usage_queue = queue.SimpleQueue()
+flush_lock = threading.Lock()
+flusher = None
+stats = {
+    "events": 0,
+    "flushes": 0,
+    "errors": 0,
+}
+
+
+def record_usage(user_id, model, prompt_tokens=0, completion_tokens=0, prompts=None, completions=None):
+    """
+    Record the usage of one call, the texts are counted later by the flusher when the API did not return the counts
+    :param user_id:
+    :param model:
+    :param prompt_tokens:
+    :param completion_tokens:
+    :param prompts: texts of the prompts to count
+    :param completions: texts of the completions to count
+    :return:
+    """
+    usage_queue.put((user_id, model, prompt_tokens, completion_tokens, prompts, completions))
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """
+    Records the tokens of every LLM call of a chain, for one user
+    """
+
+    def __init__(self, user_id, model):
+        self.user_id = user_id
+        self.model = model
+        self.prompts = {}
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.prompts[kwargs.get("run_id")] = prompts
+
+    def on_llm_end(self, response, **kwargs):
+        prompts = self.prompts.pop(kwargs.get("run_id"), [])
+        llm_output = response.llm_output or {}
+        if llm_output.get("cached"):
+            # answered from the llm cache, nothing was sent to the API
+            return
+        model = llm_output.get("model_name") or self.model
+        usage = llm_output.get("token_usage") or {}
+        if usage.get("prompt_tokens") is not None:
+            record_usage(self.user_id, model, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        else:
+            # the streamed answers come without the counts
+            completions = [generation.text for generations in response.generations for generation in generations]
+            record_usage(self.user_id, model, prompts=prompts, completions=completions)
+
+    def on_llm_error(self, error, **kwargs):
+        self.prompts.pop(kwargs.get("run_id"), None)
+
+    def on_llm_cancel(self, run_id):
+        """
+        Record the prompt of a call cancelled while in flight, the API bills it even if the answer is dropped
+        :param run_id:
+        :return:
+        """
+        prompts = self.prompts.pop(run_id, None)
+        if prompts:
+            record_usage(self.user_id, self.model, prompts=prompts)
+
+
+def get_prices():
+    """
+    Get the price of the models by name, for 1000 prompt and completion tokens
+    :return:
+    """
+    prices = {}
+    for model in get_all_models() or []:
+        try:
+            prices[model['name']] = (float(model['price_in']), float(model['price_out']))
+        except (TypeError, ValueError):
+            continue
+    return prices
+
+
+def aggregate_usage(events):
+    """
+    Sum the events by user and model
+    :param events:
+    :return: dict (user_id, model) -> dict of totals
+    """
+    totals = {}
+    for user_id, model, prompt_tokens, completion_tokens, prompts, completions in events:
+        if prompts:
+            prompt_tokens += sum(count_tokens_batch(prompts, model))
+        if completions:
+            completion_tokens += sum(count_tokens_batch(completions, model))
+        total = totals.setdefault((user_id or 0, model), {"prompt_tokens": 0, "completion_tokens": 0, "calls": 0})
+        total["prompt_tokens"] += prompt_tokens
+        total["completion_tokens"] += completion_tokens
+        total["calls"] += 1
+    return totals
+
+
+def flush_usage():
+    """
+    Write the queued usage to the database
+    :return: number of flushed events
+    """
+    with flush_lock:
+        events = []
+        while True:
+            try:
+                events.append(usage_queue.get_nowait())
+            except queue.Empty:
+                break
+        if not events:
+            return 0
+
+        totals = aggregate_usage(events)
+        prices = get_prices()
+        rows = []
+        for (user_id, model), total in totals.items():
+            price_in, price_out = prices.get(model, (0.0, 0.0))
+            cost = (total["prompt_tokens"] * price_in + total["completion_tokens"] * price_out) / 1000
+            rows.append((user_id, model, total["prompt_tokens"], total["completion_tokens"], total["calls"], cost))
+        if not add_usage(rows):
+            # kept for the next flush
+            for event in events:
+                usage_queue.put(event)
+            stats["errors"] += 1
+            return 0
+
+        stats["events"] += len(events)
+        stats["flushes"] += 1
+        return len(events)
+
+
+def run_flusher():
+    """
+    Flush the usage every flush_interval seconds
+    :return:
+    """
+    while True:
+        time.sleep(flush_interval)
+        try:
+            flush_usage()
+        except Exception as e:
+            save_error(e)
+
+
+def start_flusher():
+    """
+    Start the background thread that writes the usage
+    :return:
+    """
+    global flusher
+    if flusher is None:
+        flusher = threading.Thread(target=run_flusher, name="usage-flusher", daemon=True)
+        flusher.start()
+
+
+def get_metering_stats():
+    """
+    Get the counters of the metering
+    :return:
+    """
+    return dict(stats, queued=usage_queue.qsize())
@@ -1,6 +1,69 @@
+import decimal
+import json
 import os
 
+import orjson
+from fastapi.responses import JSONResponse
+
+from utils.async_utils import request_slot
+
 local_key = os.getenv("PUBLIC_API_KEY")
+# INT8 columns holding unique_rowid() ids
+id_columns = {"user_id", "doc_id", "conv_id", "hist_id", "job_id", "model_id", "assist_id", "error_id", "model",
+              "assistant"}
+
+
+def json_default(value):
+    """
+    Serialize the database types orjson does not know
+    :param value:
+    :return:
+    """
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    return str(value)
+
+
+def stringify_ids(value):
+    """
+    Turn the INT8 ids into strings, the unique_rowid() values are above 2^53 and JavaScript would round them
+    :param value: content of the response, the compact pages have their columns once and the rows as lists
+    :return:
+    """
+    if isinstance(value, dict):
+        if isinstance(value.get("columns"), list) and isinstance(value.get("rows"), list):
+            positions = [i for i, column in enumerate(value["columns"]) if column in id_columns]
+            if positions:
+                value = dict(value, rows=[stringify_row(row, positions) for row in value["rows"]])
+        return {key: str(item) if key in id_columns and isinstance(item, int) and not isinstance(item, bool)
+                else stringify_ids(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [stringify_ids(item) for item in value]
+    return value
+
+
+def stringify_row(row, positions):
+    """
+    Turn the ids of a compact row into strings
+    :param row: list of values
+    :param positions: indexes of the id columns
+    :return:
+    """
+    if not isinstance(row, (list, tuple)):
+        return row
+    row = list(row)
+    for i in positions:
+        if isinstance(row[i], int) and not isinstance(row[i], bool):
+            row[i] = str(row[i])
+    return row
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response serialized with orjson, keeps the native database types (timestamps, numbers, tuples)
+    except the ids, sent as strings like the other endpoints"""
+
+    def render(self, content):
+        return orjson.dumps(stringify_ids(content), default=json_default, option=orjson.OPT_NON_STR_KEYS)
 
 
 def check_api_key(api_key):
@@ -61,4 +124,28 @@ def check_result(result, err_code, err_msg):
     """
     if result == [] or result == -1 or result is None or not result:
         return return_error(err_code, err_msg)
-    return return_success(result)
\ No newline at end of file
+    return return_success(result)
+
+
+def format_sse(event, data):
+    """
+    Format one Server-Sent Event
+    :param event:
+    :param data:
+    :return:
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_events(events):
+    """
+    Turn the events of a response stream into Server-Sent Events
+    :param events:
+    :return:
+    """
+    async with request_slot():
+        try:
+            async for event in events:
+                yield format_sse(event["event"], event["data"])
+        except Exception as e:
+            yield format_sse("end", return_error(400, str(e)))
@@ -0,0 +1,125 @@
+# Token accounting shared by the memory budget, the splitting of the documents and the usage metering.
+# The encoders are loaded once per process and the texts are counted in batches.
+import threading
+
+import tiktoken
+
+default_model = "gpt-3.5-turbo"
+default_encoding = "cl100k_base"
+
+# encoding of the models, the versions of a model (gpt-3.5-turbo-0613, ...) use the encoding of the longest prefix
+model_encodings = {
+    "gpt-4": "cl100k_base",
+    "gpt-4-32k": "cl100k_base",
+    "gpt-3.5-turbo": "cl100k_base",
+    "gpt-3.5-turbo-16k": "cl100k_base",
+    "text-embedding-ada-002": "cl100k_base",
+    "text-davinci-003": "p50k_base",
+    "text-davinci-002": "p50k_base",
+    "code-davinci-002": "p50k_base",
+    "davinci": "r50k_base",
+    "curie": "r50k_base",
+    "babbage": "r50k_base",
+    "ada": "r50k_base",
+}
+
+# tokens added to every chat message and to every name in it
+message_tokens = {
+    "gpt-3.5-turbo-0301": (4, -1),
+}
+default_message_tokens = (3, 1)
+# every reply is primed with <|start|>assistant<|message|>
+reply_tokens = 3
+
+encoders = {}
+encoders_lock = threading.Lock()
+
+
+def get_encoding_name(model):
+    """
+    Get the name of the encoding of the model
+    :param model:
+    :return:
+    """
+    if not model:
+        return default_encoding
+    if model in model_encodings:
+        return model_encodings[model]
+    prefixes = [name for name in model_encodings if model.startswith(name)]
+    if prefixes:
+        return model_encodings[max(prefixes, key=len)]
+    return default_encoding
+
+
+def get_encoding(encoding_name):
+    """
+    Get the encoder by the name of the encoding, it is loaded once for the process
+    :param encoding_name:
+    :return:
+    """
+    encoder = encoders.get(encoding_name)
+    if encoder is None:
+        with encoders_lock:
+            encoder = encoders.get(encoding_name)
+            if encoder is None:
+                encoder = tiktoken.get_encoding(encoding_name)
+                encoders[encoding_name] = encoder
+    return encoder
+
+
+def get_encoder(model=default_model):
+    """
+    Get the encoder of the model
+    :param model:
+    :return:
+    """
+    return get_encoding(get_encoding_name(model))
+
+
+def count_tokens(text, model=default_model):
+    """
+    Count the tokens of the text
+    :param text:
+    :param model:
+    :return:
+    """
+    return len(get_encoder(model).encode(text, disallowed_special=()))
+
+
+def count_tokens_batch(texts, model=default_model):
+    """
+    Count the tokens of every text in one call
+    :param texts:
+    :param model:
+    :return: list of token counts, in the order of the texts
+    """
+    if not texts:
+        return []
+    return [len(tokens) for tokens in get_encoder(model).encode_batch(list(texts), disallowed_special=())]
+
+
+def count_message_tokens(messages, model=default_model):
+    """
+    Count the tokens of a chat prompt
+    :param messages: list of dict with role, content and optional name
+    :param model:
+    :return:
+    """
+    per_message, per_name = message_tokens.get(model, default_message_tokens)
+    values = [value for message in messages for value in message.values()]
+    total = sum(count_tokens_batch(values, model))
+    total += per_message * len(messages)
+    total += per_name * sum(1 for message in messages if "name" in message)
+    return total + reply_tokens
+
+
+def preload_encoders(models=()):
+    """
+    Load the encoders of the models, so the first request does not wait for them
+    :param models: names of the models
+    :return: names of the loaded encodings
+    """
+    names = {default_encoding} | {get_encoding_name(model) for model in models}
+    for name in names:
+        get_encoding(name)
+    return sorted(names)
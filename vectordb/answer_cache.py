@@ -0,0 +1,180 @@
+# Semantic cache of the answers over the documents: a question close enough to one already answered over the same
+# document gets the stored answer, sources and follow up questions without any call to the LLM.
+# The entries are kept in the memory of the worker, by doc_id, and dropped with the vector store of the document.
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+# minimum cosine similarity between the questions
+similarity_threshold = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+# seconds before an answer expires
+cache_ttl = int(os.getenv("ANSWER_CACHE_TTL", 86400))
+# answers kept by document, and documents kept
+max_answers = int(os.getenv("ANSWER_CACHE_DOC_SIZE", 256))
+max_docs = int(os.getenv("ANSWER_CACHE_SIZE", 256))
+cache_enabled = os.getenv("ANSWER_CACHE_ENABLED", "true") == "true"
+
+docs = OrderedDict()
+generations = {}
+docs_lock = threading.Lock()
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "invalidations": 0,
+}
+
+
+class DocAnswers:
+    """
+    Answers of one document, the normalized question vectors are stacked in one matrix for the lookup
+    """
+
+    def __init__(self):
+        self.vectors = None
+        self.entries = []
+
+    def find(self, vector, now):
+        """
+        Get the most similar question that has not expired
+        :param vector: normalized question vector
+        :param now:
+        :return: (similarity, entry) or (0.0, None)
+        """
+        if not self.entries:
+            return 0.0, None
+        scores = self.vectors @ vector
+        for i in np.argsort(-scores):
+            if scores[i] < similarity_threshold:
+                break
+            if now - self.entries[i]["created"] <= cache_ttl:
+                return float(scores[i]), self.entries[i]
+        return 0.0, None
+
+    def add(self, vector, entry, now):
+        """
+        Add the answer, the expired and the oldest ones are dropped above max_answers
+        :param vector: normalized question vector
+        :param entry:
+        :param now:
+        :return:
+        """
+        keep = [i for i, old in enumerate(self.entries) if now - old["created"] <= cache_ttl]
+        keep = keep[-(max_answers - 1):] if max_answers > 1 else []
+        self.entries = [self.entries[i] for i in keep] + [entry]
+        rows = [self.vectors[keep]] if keep else []
+        self.vectors = np.vstack(rows + [vector[np.newaxis, :]])
+
+
+def normalize(vector):
+    """
+    Scale the vector to length 1, so the dot product is the cosine similarity
+    :param vector:
+    :return: numpy vector or None for a null vector
+    """
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else None
+
+
+def get_cached_answer(doc_id, question_vector):
+    """
+    Get the answer of the most similar question asked over the document
+    :param doc_id:
+    :param question_vector: embedding of the question
+    :return: dict with question, answer, source, follow_up and similarity, or None
+    """
+    vector = normalize(question_vector) if cache_enabled else None
+    if vector is None:
+        return None
+    key = str(doc_id)
+    with docs_lock:
+        answers = docs.get(key)
+        similarity, entry = answers.find(vector, time.time()) if answers else (0.0, None)
+        if entry is None:
+            stats["misses"] += 1
+            return None
+        docs.move_to_end(key)
+        stats["hits"] += 1
+        return dict(entry, similarity=similarity)
+
+
+def get_answer_generation(doc_id):
+    """
+    Get the version of the document index, to read before answering and pass to set_cached_answer
+    :param doc_id:
+    :return:
+    """
+    with docs_lock:
+        return generations.get(str(doc_id), 0)
+
+
+def set_cached_answer(doc_id, generation, question_vector, question, answer, source, follow_up):
+    """
+    Save the answer of the question over the document
+    :param doc_id:
+    :param generation: version of the index the answer was built from, from get_answer_generation
+    :param question_vector: embedding of the question
+    :param question:
+    :param answer:
+    :param source: formatted sources of the answer
+    :param follow_up: list of follow up questions
+    :return:
+    """
+    vector = normalize(question_vector) if cache_enabled else None
+    if vector is None:
+        return
+    key = str(doc_id)
+    now = time.time()
+    entry = {
+        "question": question,
+        "answer": answer,
+        "source": source,
+        "follow_up": list(follow_up),
+        "created": now,
+    }
+    with docs_lock:
+        if generations.get(key, 0) != generation:
+            # the document was re-indexed while answering
+            return
+        answers = docs.get(key)
+        if answers is None:
+            answers = docs[key] = DocAnswers()
+        answers.add(vector, entry, now)
+        docs.move_to_end(key)
+        while len(docs) > max_docs:
+            docs.popitem(last=False)
+            stats["evictions"] += 1
+
+
+def invalidate_answers(doc_id):
+    """
+    Drop the answers of the document, must be called when its index is rebuilt or the document deleted
+    :param doc_id:
+    :return:
+    """
+    key = str(doc_id)
+    with docs_lock:
+        generations[key] = generations.get(key, 0) + 1
+        if docs.pop(key, None) is not None:
+            stats["invalidations"] += 1
+
+
+def get_answer_cache_stats():
+    """
+    Get the cache counters
+    :return:
+    """
+    with docs_lock:
+        requests = stats["hits"] + stats["misses"]
+        return {
+            **stats,
+            "hit_rate": stats["hits"] / requests if requests else 0.0,
+            "docs": len(docs),
+            "answers": sum(len(answers.entries) for answers in docs.values()),
+        }
@@ -0,0 +1,206 @@
+# Embedding of the document chunks for ingestion: token-bounded batches, several batches in flight,
+# concurrency adapted to the rate limits of the API
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+from dotenv import load_dotenv
+from langchain.embeddings.openai import OpenAIEmbeddings
+
+from utils.metering import record_usage
+from utils.tokens import count_tokens_batch
+
+load_dotenv()
+# tokens and chunks in one request to the embedding API
+batch_tokens = int(os.getenv("EMBED_BATCH_TOKENS", 50000))
+batch_inputs = int(os.getenv("EMBED_BATCH_SIZE", 512))
+# requests in flight for one document
+max_concurrency = int(os.getenv("EMBED_MAX_CONCURRENCY", 4))
+max_retries = int(os.getenv("EMBED_MAX_RETRIES", 8))
+
+ingest_model = None
+
+
+def get_ingest_model():
+    """
+    Get the embedding model for ingestion, it does not retry by itself so rate limits reach the limiter
+    :return:
+    """
+    global ingest_model
+    if ingest_model is None:
+        ingest_model = OpenAIEmbeddings(max_retries=1, chunk_size=batch_inputs)
+    return ingest_model
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that is halved on every rate limit and grows back by one after a round of successes
+    """
+
+    def __init__(self, limit):
+        self.max_limit = limit
+        self.limit = limit
+        self.active = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot
+        :return:
+        """
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, success=True):
+        """
+        Free the slot
+        :param success: the request was not rate limited
+        :return:
+        """
+        with self.condition:
+            self.active -= 1
+            if success:
+                self.successes += 1
+                if self.successes >= self.limit and self.limit < self.max_limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.condition.notify_all()
+
+    def throttle(self):
+        """
+        Halve the limit after a rate limit
+        :return:
+        """
+        with self.condition:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+
+
+def get_backoff(attempt, base=1.0, cap=60.0):
+    """
+    Exponential backoff with full jitter
+    :param attempt:
+    :param base:
+    :param cap:
+    :return: seconds to wait
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def pack_batches(texts, max_tokens=None, max_inputs=None):
+    """
+    Group the texts into batches below the token and size limits of one request
+    :param texts:
+    :param max_tokens:
+    :param max_inputs:
+    :return: list of batches of text indexes
+    """
+    max_tokens = max_tokens or batch_tokens
+    max_inputs = max_inputs or batch_inputs
+    batches = []
+    batch = []
+    tokens = 0
+    for i, count in enumerate(count_tokens_batch(texts, "text-embedding-ada-002")):
+        if batch and (tokens + count > max_tokens or len(batch) >= max_inputs):
+            batches.append(batch)
+            batch = []
+            tokens = 0
+        batch.append(i)
+        tokens += count
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_batch(texts, limiter):
+    """
+    Embed one batch, wait and retry when the API is rate limited
+    :param texts:
+    :param limiter:
+    :return:
+    """
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            vectors = get_ingest_model().embed_documents(texts)
+        except openai.error.RateLimitError:
+            limiter.release(False)
+            limiter.throttle()
+            if attempt >= max_retries:
+                raise
+            time.sleep(get_backoff(attempt))
+            attempt += 1
+            continue
+        except Exception:
+            limiter.release(False)
+            raise
+        limiter.release(True)
+        return vectors
+
+
+def add_to_store(store, docs, vectors):
+    """
+    Write the chunks with their vectors to the index
+    :param store:
+    :param docs:
+    :param vectors:
+    :return:
+    """
+    store._collection.add(
+        ids=[str(uuid.uuid1()) for _ in docs],
+        embeddings=vectors,
+        metadatas=[doc.metadata for doc in docs],
+        documents=[doc.page_content for doc in docs],
+    )
+
+
+def embed_into_store(docs, store, cached_embeddings, user_id=None):
+    """
+    Embed the chunks and write them to the index as the batches complete
+    :param docs: chunks of the document
+    :param store: Chroma index
+    :param cached_embeddings: embedding cache, cached chunks are not sent to the API
+    :param user_id: user metered for the embedded chunks
+    :return: ingestion report
+    """
+    start = time.time()
+    texts = [doc.page_content for doc in docs]
+    vectors = cached_embeddings.lookup(texts)
+
+    cached = [i for i, vector in enumerate(vectors) if vector is not None]
+    if cached:
+        add_to_store(store, [docs[i] for i in cached], [vectors[i] for i in cached])
+
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    batches = [[missing[i] for i in batch] for batch in pack_batches([texts[i] for i in missing])]
+    limiter = AdaptiveLimiter(max_concurrency)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="embed") as executor:
+        futures = {executor.submit(embed_batch, [texts[i] for i in batch], limiter): batch for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            batch_vectors = future.result()
+            cached_embeddings.store([texts[i] for i in batch], batch_vectors)
+            add_to_store(store, [docs[i] for i in batch], batch_vectors)
+            record_usage(user_id, get_ingest_model().model, prompts=[texts[i] for i in batch])
+
+    seconds = time.time() - start
+    report = {
+        "chunks": len(docs),
+        "cached": len(cached),
+        "embedded": len(missing),
+        "batches": len(batches),
+        "seconds": round(seconds, 3),
+        "chunks_per_sec": round(len(docs) / seconds, 1) if seconds > 0 else len(docs),
+    }
+    logging.info("Embedding report: %s", report)
+    return report
@@ -0,0 +1,132 @@
+# Embeddings cached on disk by model and hash of the text
+import hashlib
+import os
+import threading
+from array import array
+
+from dotenv import load_dotenv
+from langchain.embeddings.base import Embeddings
+
+from utils.disk_cache import DiskCache
+
+load_dotenv()
+cache_path = os.getenv("EMBEDDING_CACHE_PATH", "./cache/embeddings.sqlite")
+cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 2000000))
+
+stats_lock = threading.Lock()
+stats = {
+    "hits": 0,
+    "misses": 0,
+}
+
+
+def get_embedding_key(model, text):
+    """
+    Get the cache key of the text
+    :param model:
+    :param text:
+    :return:
+    """
+    return model + ":" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def encode_vector(vector):
+    """
+    Pack the vector as float32 bytes
+    :param vector:
+    :return:
+    """
+    return array("f", vector).tobytes()
+
+
+def decode_vector(data):
+    """
+    Unpack float32 bytes to the vector
+    :param data:
+    :return:
+    """
+    vector = array("f")
+    vector.frombytes(data)
+    return vector.tolist()
+
+
+def count_lookup(hits, misses):
+    """
+    Update the cache counters
+    :param hits:
+    :param misses:
+    :return:
+    """
+    with stats_lock:
+        stats["hits"] += hits
+        stats["misses"] += misses
+
+
+def get_embedding_cache_stats():
+    """
+    Get the cache counters
+    :return:
+    """
+    with stats_lock:
+        return dict(stats)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings that only call the wrapped model for texts that were never embedded before
+    """
+
+    def __init__(self, embeddings, cache=None):
+        self.embeddings = embeddings
+        self.model = getattr(embeddings, "model", embeddings.__class__.__name__)
+        self.cache = cache or DiskCache(cache_path, cache_max_entries)
+
+    def lookup(self, texts):
+        """
+        Get the cached vectors of the texts
+        :param texts:
+        :return: list of vectors with None for the texts that are not cached
+        """
+        keys = [get_embedding_key(self.model, text) for text in texts]
+        found = self.cache.get_many(keys)
+        vectors = [decode_vector(found[key]) if key in found else None for key in keys]
+        hits = sum(1 for vector in vectors if vector is not None)
+        count_lookup(hits, len(vectors) - hits)
+        return vectors
+
+    def store(self, texts, vectors):
+        """
+        Save the vectors of the texts
+        :param texts:
+        :param vectors:
+        :return:
+        """
+        self.cache.set_many({get_embedding_key(self.model, text): encode_vector(vector)
+                             for text, vector in zip(texts, vectors)})
+
+    def embed_documents(self, texts):
+        """
+        Embed the texts, only the ones missing from the cache go to the model
+        :param texts:
+        :return:
+        """
+        vectors = self.lookup(texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            new_vectors = self.embeddings.embed_documents(missing)
+            self.store(missing, new_vectors)
+            computed = dict(zip(missing, new_vectors))
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return vectors
+
+    def embed_query(self, text):
+        """
+        Embed the query
+        :param text:
+        :return:
+        """
+        vector = self.lookup([text])[0]
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.store([text], [vector])
+        return vector
@@ -0,0 +1,141 @@
+# Background processing of the uploaded documents: vector index and summary, one stage after the other.
+# The progress is kept in the ingest_jobs table so a restarted worker continues after the last completed stage.
+# The workers renew the lease of their running jobs, and look periodically for the jobs whose lease expired
+# because their worker stopped.
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from cocroach_utils.database_utils import save_error
+from cocroach_utils.db_jobs import add_job, claim_job, get_resumable_jobs, update_job, get_active_job, renew_jobs
+from conversation.conv import get_doc_summary
+from vectordb.vectordb import build_vector_index
+
+load_dotenv()
+ingest_workers = int(os.getenv("INGEST_WORKERS", 2))
+# seconds after which a running job whose lease was not renewed is picked up again
+job_lease = int(os.getenv("INGEST_JOB_LEASE", 120))
+# seconds between two renewals of the leases and two scans for the abandoned jobs
+heartbeat_interval = job_lease / 3
+
+executor = ThreadPoolExecutor(max_workers=ingest_workers, thread_name_prefix="ingest")
+# jobs submitted by this worker and not finished yet
+submitted_jobs = set()
+submitted_lock = threading.Lock()
+scheduler = None
+
+
+def submit_job(job_id):
+    """
+    Run the job in the background, once per worker
+    :param job_id:
+    :return: False if the job is already submitted
+    """
+    with submitted_lock:
+        if job_id in submitted_jobs:
+            return False
+        submitted_jobs.add(job_id)
+    future = executor.submit(run_job, job_id)
+    future.add_done_callback(lambda _: discard_job(job_id))
+    return True
+
+
+def discard_job(job_id):
+    with submitted_lock:
+        submitted_jobs.discard(job_id)
+
+
+def enqueue_job(doc_id, user_id, filename):
+    """
+    Create the job for the uploaded file and start it in the background,
+    a document uploaded again while it is being ingested keeps its running job
+    :param doc_id:
+    :param user_id:
+    :param filename:
+    :return: job_id
+    """
+    job_id = add_job(doc_id, user_id, filename)
+    if job_id is None:
+        job = get_active_job(doc_id)
+        if job is not None:
+            return job['job_id']
+        # the active job ended in between
+        job_id = add_job(doc_id, user_id, filename)
+        if job_id is None:
+            return -1
+    if job_id != -1:
+        submit_job(job_id)
+    return job_id
+
+
+def resume_jobs():
+    """
+    Start again the jobs that are queued or were interrupted
+    :return: number of resumed jobs
+    """
+    jobs = get_resumable_jobs(job_lease)
+    return sum(1 for job in jobs if submit_job(job['job_id']))
+
+
+def run_scheduler():
+    """
+    Renew the leases of the jobs of this worker and resume the abandoned jobs, every heartbeat_interval seconds
+    :return:
+    """
+    while True:
+        try:
+            with submitted_lock:
+                job_ids = list(submitted_jobs)
+            if job_ids:
+                renew_jobs(job_ids)
+            resume_jobs()
+        except Exception as e:
+            save_error(e)
+        time.sleep(heartbeat_interval)
+
+
+def start_scheduler():
+    """
+    Start the background thread that resumes the interrupted jobs, the first scan runs now
+    :return:
+    """
+    global scheduler
+    if scheduler is None:
+        scheduler = threading.Thread(target=run_scheduler, name="ingest-scheduler", daemon=True)
+        scheduler.start()
+
+
+def run_job(job_id):
+    """
+    Run the remaining stages of the job
+    :param job_id:
+    :return:
+    """
+    job = claim_job(job_id, job_lease)
+    if job is None:
+        return
+
+    stage = job['stage']
+    try:
+        if stage == "uploaded":
+            res = build_vector_index(job['filename'], job['doc_id'], True, job['user_id'])
+            if res['status'] != 'success':
+                update_job(job_id, stage, "error", res.get('error', res['message']))
+                return
+            stage = "indexed"
+            update_job(job_id, stage, "running")
+
+        if stage == "indexed":
+            res = get_doc_summary(job['filename'], job['doc_id'], user_id=job['user_id'])
+            if res['status'] != 'success':
+                update_job(job_id, stage, "error", res['message'])
+                return
+            stage = "summarized"
+
+        update_job(job_id, stage, "done")
+    except Exception as e:
+        save_error(e)
+        update_job(job_id, stage, "error", str(e))
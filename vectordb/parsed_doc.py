@@ -0,0 +1,118 @@
+# Parse-once representation of the uploaded documents: the pages are loaded and tokenized a single time,
+# stored on disk as one array of token ids with the page offsets, and every chunking is a slice of it
+import hashlib
+import json
+import os
+from array import array
+
+from langchain.schema import Document
+
+from utils.tokens import get_encoding
+
+encoding_name = "cl100k_base"
+parsed_directory = './data/parsed'
+
+encoding = get_encoding(encoding_name)
+
+if not os.path.exists(parsed_directory):
+    os.makedirs(parsed_directory)
+
+
+def get_parsed_key(filename):
+    """
+    Get the key of the parsed file, it changes when the file is replaced
+    :param filename:
+    :return:
+    """
+    stat = os.stat(filename)
+    source = f"{os.path.abspath(filename)}:{stat.st_size}:{stat.st_mtime_ns}:{encoding_name}"
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def save_parsed_document(key, parsed):
+    """
+    Save the token ids and the pages of the parsed document
+    :param key:
+    :param parsed:
+    :return:
+    """
+    path = os.path.join(parsed_directory, key)
+    with open(path + ".tokens.tmp", "wb") as tokens_file:
+        parsed["tokens"].tofile(tokens_file)
+    with open(path + ".json.tmp", "w") as pages_file:
+        json.dump(parsed["pages"], pages_file, default=str)
+    # the pages file is written last, a parse is complete only when it exists
+    os.replace(path + ".tokens.tmp", path + ".tokens")
+    os.replace(path + ".json.tmp", path + ".json")
+
+
+def load_parsed_document(key):
+    """
+    Load the parsed document from disk
+    :param key:
+    :return: parsed document or None if it was not parsed yet
+    """
+    path = os.path.join(parsed_directory, key)
+    if not os.path.exists(path + ".json"):
+        return None
+    with open(path + ".json") as pages_file:
+        pages = json.load(pages_file)
+    tokens = array("I")
+    with open(path + ".tokens", "rb") as tokens_file:
+        tokens.frombytes(tokens_file.read())
+    return {
+        "tokens": tokens,
+        "pages": pages
+    }
+
+
+def parse_document(filename, loader):
+    """
+    Get the tokenized pages of the file, it is loaded with the loader only the first time
+    :param filename:
+    :param loader:
+    :return: dict with the token ids of the whole document and the start, end and metadata of every page
+    """
+    key = get_parsed_key(filename)
+    parsed = load_parsed_document(key)
+    if parsed is not None:
+        return parsed
+
+    documents = loader.load()
+    tokens = array("I")
+    pages = []
+    for document, token_ids in zip(documents, encoding.encode_batch([doc.page_content for doc in documents],
+                                                                    disallowed_special=())):
+        pages.append({
+            "start": len(tokens),
+            "end": len(tokens) + len(token_ids),
+            "metadata": document.metadata,
+        })
+        tokens.extend(token_ids)
+
+    parsed = {
+        "tokens": tokens,
+        "pages": pages
+    }
+    save_parsed_document(key, parsed)
+    return parsed
+
+
+def split_parsed_document(parsed, chunk_size, chunk_overlap):
+    """
+    Split the parsed document into chunks of tokens, like TokenTextSplitter does for every page
+    :param parsed:
+    :param chunk_size:
+    :param chunk_overlap:
+    :return: list of Document
+    """
+    tokens = parsed["tokens"]
+    docs = []
+    for page in parsed["pages"]:
+        start = page["start"]
+        while start < page["end"]:
+            end = min(start + chunk_size, page["end"])
+            docs.append(Document(page_content=encoding.decode(tokens[start:end].tolist()),
+                                 metadata=dict(page["metadata"])))
+            start += chunk_size - chunk_overlap
+    return docs
@@ -0,0 +1,114 @@
+# Process-wide cache of the opened Chroma indexes, one per document
+import os
+import threading
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+from langchain.vectorstores import Chroma
+
+from vectordb.answer_cache import invalidate_answers
+
+load_dotenv()
+persist_directory = './db'
+# how many document indexes stay open
+max_stores = int(os.getenv("VECTOR_STORE_CACHE_SIZE", 32))
+# memory budget for the open indexes, estimated from their size on disk
+max_bytes = int(os.getenv("VECTOR_STORE_CACHE_MB", 2048)) * 1024 * 1024
+
+stores = OrderedDict()
+generations = {}
+stores_lock = threading.Lock()
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "invalidations": 0,
+}
+
+
+def get_index_size(index_dir):
+    """
+    Get the size of the index on disk in bytes
+    :param index_dir:
+    :return:
+    """
+    size = 0
+    for root, dirs, files in os.walk(index_dir):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
+def evict_stores():
+    """
+    Close the least recently used indexes until the cache fits its limits, the newest one always stays
+    :return:
+    """
+    total = sum(size for store, size in stores.values())
+    while len(stores) > 1 and (len(stores) > max_stores or total > max_bytes):
+        doc_id, (store, size) = stores.popitem(last=False)
+        total -= size
+        stats["evictions"] += 1
+
+
+def get_vector_store(doc_id, embedding_function):
+    """
+    Get the opened index of the document, open it if it is not cached yet
+    :param doc_id:
+    :param embedding_function:
+    :return:
+    """
+    key = str(doc_id)
+    with stores_lock:
+        if key in stores:
+            stores.move_to_end(key)
+            stats["hits"] += 1
+            return stores[key][0]
+        stats["misses"] += 1
+        generation = generations.get(key, 0)
+
+    index_dir = os.path.join(persist_directory, key)
+    store = Chroma(persist_directory=index_dir, embedding_function=embedding_function)
+    size = get_index_size(index_dir)
+
+    with stores_lock:
+        if key in stores:
+            # opened by another request in the meantime
+            stores.move_to_end(key)
+            return stores[key][0]
+        if generations.get(key, 0) == generation:
+            # do not cache an index that was rebuilt while we were opening it
+            stores[key] = (store, size)
+            evict_stores()
+    return store
+
+
+def invalidate_vector_store(doc_id):
+    """
+    Drop the cached index and answers of the document, must be called when the index is rebuilt or the document deleted
+    :param doc_id:
+    :return:
+    """
+    key = str(doc_id)
+    with stores_lock:
+        generations[key] = generations.get(key, 0) + 1
+        if stores.pop(key, None) is not None:
+            stats["invalidations"] += 1
+    # the cached answers were built from the old index
+    invalidate_answers(doc_id)
+
+
+def get_vector_store_stats():
+    """
+    Get the cache counters
+    :return:
+    """
+    with stores_lock:
+        return {
+            **stats,
+            "open": len(stores),
+            "bytes": sum(size for store, size in stores.values()),
+        }
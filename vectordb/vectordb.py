@@ -1,17 +1,23 @@
+import hashlib
 import os
 import shutil
+import uuid
 from pathlib import Path
 
 from dotenv import load_dotenv
 from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.text_splitter import CharacterTextSplitter, TokenTextSplitter
+from langchain.text_splitter import CharacterTextSplitter
 from langchain.vectorstores import Chroma
 from langchain.document_loaders import TextLoader, PyPDFLoader, UnstructuredEPubLoader, UnstructuredWordDocumentLoader, \
     UnstructuredFileLoader
 from langchain.document_loaders import DirectoryLoader
 
 from cocroach_utils.database_utils import save_error
-from cocroach_utils.db_docs import add_doc, get_doc_by_name
+from cocroach_utils.db_docs import add_doc, get_doc_by_hash, get_doc_by_id, update_doc_field_by_id
+from vectordb.batch_embedder import embed_into_store
+from vectordb.embedding_cache import CachedEmbeddings
+from vectordb.parsed_doc import parse_document, split_parsed_document
+from vectordb.store_cache import invalidate_vector_store
 
 # from langchain.embeddings import HuggingFaceEmbeddings
 # from langchain.embeddings import HuggingFaceInstructEmbeddings
@@ -27,6 +33,8 @@ chunk_overlap = 32
 persist_directory = './db'
 data_directory = './data'
 local_embeddings = False
+upload_block_size = 1024 * 1024
+embedding_model = None
 
 
 # if local_embeddings:
@@ -44,11 +52,14 @@ if not os.path.exists(persist_directory):
 
 def get_embedding_model(local=False):
     """
-    Get the embedding model
+    Get the embedding model, the instance is shared by the whole process and caches the embeddings on disk
     :param local:
     :return:
     """
-    return OpenAIEmbeddings()
+    global embedding_model
+    if embedding_model is None:
+        embedding_model = CachedEmbeddings(OpenAIEmbeddings())
+    return embedding_model
     # if local:
     #     return instructor_embeddings
     # else:
@@ -78,12 +89,74 @@ def get_loader(filename):
         return None
 
 
-def create_vector_index(file, user_id, force):
+def store_upload_file(file):
     """
-    Create a vector index from a file
-    :param force:
+    Stream the upload to disk while hashing it, the file is stored under its content hash
+    :param file:
+    :return: path of the stored file and sha256 of the content
+    """
+    tmp_directory = os.path.join(data_directory, 'tmp')
+    if not os.path.exists(tmp_directory):
+        os.makedirs(tmp_directory)
+
+    content_hash = hashlib.sha256()
+    tmp_filename = os.path.join(tmp_directory, uuid.uuid4().hex)
+    with open(Path(tmp_filename), "wb") as file_object:
+        while True:
+            block = file.file.read(upload_block_size)
+            if not block:
+                break
+            content_hash.update(block)
+            file_object.write(block)
+
+    content_hash = content_hash.hexdigest()
+    extension = os.path.splitext(file.filename)[1].lower()
+    filename = os.path.join(data_directory, content_hash + extension)
+    if os.path.exists(filename):
+        os.remove(tmp_filename)
+    else:
+        os.replace(tmp_filename, filename)
+    return filename, content_hash
+
+
+def is_doc_ingested(doc):
+    """
+    Check if the doc has its vector index and summary
+    :param doc:
+    :return:
+    """
+    if not doc:
+        return False
+    index_directory = os.path.join(persist_directory, str(doc['doc_id']), 'index')
+    return os.path.exists(index_directory) and doc['summary'] not in ('', 'None')
+
+
+def copy_ingested_doc(source, user_id, doc_name, content_hash):
+    """
+    Create the doc for the user from a doc with the same content, the index and the summary are copied
+    :param source:
     :param user_id:
+    :param doc_name:
+    :param content_hash:
+    :return: doc_id
+    """
+    doc_id = add_doc(user_id, doc_name, source['summary'], content_hash)
+    if doc_id == -1:
+        return -1
+    shutil.copytree(os.path.join(persist_directory, str(source['doc_id'])),
+                    os.path.join(persist_directory, str(doc_id)), dirs_exist_ok=True)
+    if source.get('summary_steps') not in (None, '', 'None'):
+        update_doc_field_by_id(doc_id, "summary_steps", source['summary_steps'])
+    return doc_id
+
+
+def save_upload(file, user_id, force):
+    """
+    Save the uploaded file and get the document for it.
+    Files already ingested are reused, "indexed" in the result tells if the ingestion can be skipped
     :param file:
+    :param user_id:
+    :param force: ingest again even if the user already has the same file
     :return:
     """
 
@@ -93,24 +166,53 @@ def create_vector_index(file, user_id, force):
             "message": "No file selected"
         }
 
-    filename = f"./data/{file.filename}"
+    filename, content_hash = store_upload_file(file)
 
-    docs = get_doc_by_name(file.filename)
-    if not force:
-        if docs:
-            return {
-                    "status": "error",
-                    "message": "File already exists"
-            }
-
-    if not docs:
-        doc_id = add_doc(user_id, file.filename, "")
+    indexed = False
+    doc = get_doc_by_hash(content_hash, user_id)
+    if doc and not force:
+        # the user uploads the same file again
+        doc_id = doc['doc_id']
+        indexed = is_doc_ingested(doc)
+    elif doc:
+        doc_id = doc['doc_id']
     else:
-        doc_id = docs['doc_id']
+        source = get_doc_by_hash(content_hash)
+        if not force and is_doc_ingested(source):
+            # the same file was ingested for another user or under another name
+            doc_id = copy_ingested_doc(source, user_id, file.filename, content_hash)
+            indexed = True
+        else:
+            doc_id = add_doc(user_id, file.filename, "", content_hash)
 
+    if doc_id == -1:
+        return {
+            "status": "error",
+            "message": "Cant create document"
+        }
+
+    return {
+        "status": "success",
+        "message": "Index already exists" if indexed else "File uploaded",
+        "data": {
+            "filename": filename,
+            "doc_id": str(doc_id),
+            "content_hash": content_hash,
+            "indexed": indexed
+        }
+    }
+
+
+def build_vector_index(filename, doc_id, force, user_id=None):
+    """
+    Create the vector index of the saved file
+    :param filename:
+    :param doc_id:
+    :param force:
+    :param user_id: user metered for the embeddings
+    :return:
+    """
     save_directory = os.path.join(persist_directory, str(doc_id))
-    with open(Path(filename), "wb+") as file_object:
-        shutil.copyfileobj(file.file, file_object)
 
     if not os.path.exists(os.path.join(save_directory, 'index')) or force:
 
@@ -121,16 +223,24 @@ def create_vector_index(file, user_id, force):
                 "message": "File format is not supported"
             }
 
-        documents = loader.load()
-        # text_splitter = CharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-        text_splitter = TokenTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
-                                          encoding_name="cl100k_base")
-        docs = text_splitter.split_documents(documents)
+        # the file is parsed and tokenized once, the summary reuses it
+        docs = split_parsed_document(parse_document(filename, loader), chunk_size, chunk_overlap)
+        # the file is stored under its hash, the sources show the uploaded name
+        doc = get_doc_by_id(doc_id)
+        source_name = doc['name'] if doc else os.path.basename(filename)
+        for doc_chunk in docs:
+            doc_chunk.metadata["source"] = source_name
 
         try:
-            embedding = OpenAIEmbeddings()
-            vectordb = Chroma.from_documents(documents=docs, embedding=embedding, persist_directory=save_directory)
+            # the cached index of the document is outdated from now on
+            invalidate_vector_store(doc_id)
+            if os.path.exists(save_directory):
+                shutil.rmtree(save_directory)
+            embedding = get_embedding_model()
+            vectordb = Chroma(persist_directory=save_directory, embedding_function=embedding)
+            report = embed_into_store(docs, vectordb, embedding, user_id)
             vectordb.persist()
+            invalidate_vector_store(doc_id)
         except Exception as e:
             save_error(e)
             return {
@@ -145,7 +255,8 @@ def create_vector_index(file, user_id, force):
             "data": {
                 "filename": filename,
                 "save_directory": save_directory,
-                "doc_id": str(doc_id)
+                "doc_id": str(doc_id),
+                "embedding": report
             }
         }
 
@@ -161,6 +272,20 @@ def create_vector_index(file, user_id, force):
         }
 
 
+def create_vector_index(file, user_id, force):
+    """
+    Create a vector index from a file
+    :param force:
+    :param user_id:
+    :param file:
+    :return:
+    """
+    res = save_upload(file, user_id, force)
+    if res['status'] != 'success' or res['data']['indexed']:
+        return res
+    return build_vector_index(res['data']['filename'], res['data']['doc_id'], force, user_id)
+
+
 def create_vector_index_folder():
 
     data_directory = './data/summary'